@@ -0,0 +1,188 @@
+""" Precomputed usage analytics.
+
+    Curation counts per canvas and manifest and heatmaps of how often each
+    region of a canvas is cut out are kept in aggregate tables. Whenever
+    Curation elements are inserted or deleted, their canvases are marked as
+    dirty (in the same transaction), and the aggregates of dirty canvases
+    and their manifests are recomputed at the end of every crawl of an
+    Activity Stream (see crawler.crawl_single).
+
+    Usage:
+        python3 analytics.py            refresh the aggregates of dirty
+                                        canvases
+        python3 analytics.py --rebuild  recompute all aggregates (e.g. after
+                                        changing heatmap_cell_size)
+"""
+
+import sys
+from sqlalchemy import text as sqla_text
+from config import get_cfg
+from db import get_engine
+from logger import log
+from queries import AREA_XYWH_COLUMNS
+
+# arbitrary but fixed key for pg_advisory_xact_lock, serializes refreshes
+ANALYTICS_LOCK_ID = 74220003
+
+
+def mark_canvases_dirty(can_db_ids, db_conn):
+    """ Mark canvases whose Curation elements changed. Should be called in
+        the transaction that changes them.
+    """
+
+    if not can_db_ids:
+        return
+    q = sqla_text('''
+        INSERT INTO analytics_dirty_canvases(canvas_id)
+        SELECT DISTINCT unnest(CAST(:ids AS INTEGER[]))
+        ON CONFLICT (canvas_id)
+        DO NOTHING''')
+    db_conn.execute(q, ids=list(can_db_ids))
+
+
+def mark_all_canvases_dirty(db_conn):
+    db_conn.execute('''
+        INSERT INTO analytics_dirty_canvases(canvas_id)
+        SELECT id FROM canvases
+        ON CONFLICT (canvas_id)
+        DO NOTHING''')
+
+
+def refresh_analytics(db_engine):
+    """ Recompute the aggregates of all dirty canvases and their manifests.
+        Return the number of refreshed canvases.
+    """
+
+    cell_size = get_cfg().heatmap_cell_size
+    with db_engine.begin() as db_conn:
+        db_conn.execute(sqla_text('SELECT pg_advisory_xact_lock(:id)'),
+                        id=ANALYTICS_LOCK_ID)
+        can_db_ids = [row[0] for row in db_conn.execute(
+            'DELETE FROM analytics_dirty_canvases RETURNING canvas_id'
+            )]
+        if not can_db_ids:
+            return 0
+        man_uris = [row[0] for row in db_conn.execute(sqla_text('''
+            SELECT DISTINCT manifest_jsonld_id
+            FROM canvases
+            WHERE id = ANY(CAST(:ids AS INTEGER[]))'''), ids=can_db_ids)]
+        params = {'ids': can_db_ids, 'mids': man_uris,
+                  'cell_size': cell_size}
+        for q in [
+                '''DELETE FROM canvas_stats
+                WHERE canvas_id = ANY(CAST(:ids AS INTEGER[]))''',
+                '''INSERT INTO canvas_stats(canvas_id, jsonld_id,
+                                            manifest_jsonld_id, curations,
+                                            elements)
+                SELECT canvases.id, canvases.jsonld_id,
+                    canvases.manifest_jsonld_id,
+                    count(DISTINCT curation_elements.curation_id), count(*)
+                FROM canvases
+                JOIN curation_elements
+                ON curation_elements.canvas_id = canvases.id
+                WHERE canvases.id = ANY(CAST(:ids AS INTEGER[]))
+                GROUP BY canvases.id''',
+                '''DELETE FROM canvas_heatmaps
+                WHERE canvas_id = ANY(CAST(:ids AS INTEGER[]))''',
+                # every element counts for all grid cells it overlaps
+                '''INSERT INTO canvas_heatmaps(canvas_id, cell_size, cell_x,
+                                               cell_y, count)
+                SELECT canvas_id, :cell_size, cell_x, cell_y, count(*)
+                FROM
+                    (SELECT canvas_id, {}
+                    FROM curation_elements
+                    WHERE canvas_id = ANY(CAST(:ids AS INTEGER[]))) as cue,
+                    generate_series(x / :cell_size,
+                                    (x + w - 1) / :cell_size) AS cell_x,
+                    generate_series(y / :cell_size,
+                                    (y + h - 1) / :cell_size) AS cell_y
+                GROUP BY canvas_id, cell_x, cell_y'''.format(
+                    AREA_XYWH_COLUMNS
+                    ),
+                '''DELETE FROM manifest_stats
+                WHERE manifest_jsonld_id = ANY(CAST(:mids AS TEXT[]))''',
+                '''INSERT INTO manifest_stats(manifest_jsonld_id, canvases,
+                                              curations, elements)
+                SELECT canvases.manifest_jsonld_id,
+                    count(DISTINCT canvases.id),
+                    count(DISTINCT curation_elements.curation_id), count(*)
+                FROM canvases
+                JOIN curation_elements
+                ON curation_elements.canvas_id = canvases.id
+                WHERE canvases.manifest_jsonld_id = ANY(CAST(:mids AS TEXT[]))
+                GROUP BY canvases.manifest_jsonld_id''']:
+            db_conn.execute(sqla_text(q), **params)
+    log('Refreshed analytics of {} canvases'.format(len(can_db_ids)))
+    return len(can_db_ids)
+
+
+def top_canvases(db_engine, limit, manifest_uri=None):
+    """ Return the most curated canvases (optionally only those of a
+        manifest) as a list of dicts.
+    """
+
+    params = {'limit': limit}
+    manifest_query_insert = ''
+    if manifest_uri:
+        manifest_query_insert = 'WHERE manifest_jsonld_id=:man_uri'
+        params['man_uri'] = manifest_uri
+    q = sqla_text('''
+        SELECT jsonld_id, manifest_jsonld_id, curations, elements
+        FROM canvas_stats
+        {}
+        ORDER BY curations DESC, elements DESC, canvas_id
+        LIMIT :limit'''.format(manifest_query_insert))
+    return [{'canvas': row[0], 'manifest': row[1], 'curations': row[2],
+             'elements': row[3]}
+            for row in db_engine.execute(q, **params)]
+
+
+def top_manifests(db_engine, limit):
+    """ Return the most curated manifests as a list of dicts.
+    """
+
+    q = sqla_text('''
+        SELECT manifest_jsonld_id, canvases, curations, elements
+        FROM manifest_stats
+        ORDER BY curations DESC, elements DESC, manifest_jsonld_id
+        LIMIT :limit''')
+    return [{'manifest': row[0], 'canvases': row[1], 'curations': row[2],
+             'elements': row[3]}
+            for row in db_engine.execute(q, limit=limit)]
+
+
+def canvas_heatmap(db_engine, canvas_uri):
+    """ Return the heatmap of a canvas (of all manifests containing it) as a
+        dict, or None if no Curation elements are known for the canvas.
+    """
+
+    q = sqla_text('''
+        SELECT canvas_heatmaps.cell_size, cell_x, cell_y,
+            sum(canvas_heatmaps.count) as count
+        FROM canvas_heatmaps
+        JOIN canvases
+        ON canvases.id = canvas_heatmaps.canvas_id
+        WHERE canvases.jsonld_id=:can_uri
+        GROUP BY canvas_heatmaps.cell_size, cell_x, cell_y
+        ORDER BY cell_y, cell_x''')
+    rows = db_engine.execute(q, can_uri=canvas_uri).fetchall()
+    if not rows:
+        return None
+    cell_size = rows[0]['cell_size']
+    return {
+        'canvas': canvas_uri,
+        'cell_size': cell_size,
+        'max_count': max(int(row['count']) for row in rows),
+        # (x, y, count) of every cell with a count above zero
+        'cells': [[row['cell_x'] * cell_size, row['cell_y'] * cell_size,
+                   int(row['count'])]
+                  for row in rows],
+        }
+
+
+if __name__ == '__main__':
+    db_engine = get_engine(get_cfg().db_uri)
+    if '--rebuild' in sys.argv[1:]:
+        with db_engine.begin() as db_conn:
+            mark_all_canvases_dirty(db_conn)
+    print('Refreshed {} canvases'.format(refresh_analytics(db_engine)))
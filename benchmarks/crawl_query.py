@@ -0,0 +1,440 @@
+""" Benchmark of crawling and trace queries.
+
+    Generates a synthetic Activity Stream of Curations, serves it from a
+    local HTTP server, crawls it into a PostGIS DB and then load-tests the
+    trace endpoint. Reports crawl throughput and query latencies and saves
+    them as JSON, so that results of different versions can be compared.
+
+    With --check-host-limit, it instead crawls two Activity Streams served
+    from the same host at once with crawl_per_host_limit 1 and 2, and fails
+    if the crawls don't finish (e.g. because they wait for each other's host
+    slots).
+
+    The given DB is EMPTIED before crawling, so use a dedicated one.
+
+    Usage:
+        python3 benchmarks/crawl_query.py --db-uri <uri> [options]
+        (see --help for options)
+"""
+
+import argparse
+import datetime
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, REPO_DIR)
+
+from config import get_cfg  # noqa: E402
+
+IMAGE_SIZE = 5000
+
+
+class SyntheticActivityStream():
+    """ A deterministic Activity Stream of Create activities for Curations.
+
+        Every Curation has the given number of selections (ranges within a
+        random manifest), each with the given number of cutouts on random
+        canvases of that manifest.
+    """
+
+    def __init__(self, base_url, pages, activities, selections, cutouts,
+                 manifests, canvases, seed=0):
+        self.base_url = base_url
+        self.pages = pages
+        self.activities = activities
+        self.selections = selections
+        self.cutouts = cutouts
+        self.manifests = manifests
+        self.canvases = canvases
+        self.seed = seed
+        self.start_time = datetime.datetime(2020, 1, 1)
+
+    def manifest_uri(self, m):
+        return 'http://example.org/iiif/{}/manifest'.format(m)
+
+    def canvas_uri(self, m, c):
+        return 'http://example.org/iiif/{}/canvas/{}'.format(m, c)
+
+    def all_canvas_uris(self):
+        return [self.canvas_uri(m, c) for m in range(self.manifests)
+                for c in range(self.canvases)]
+
+    def collection(self):
+        return {
+            '@context': 'https://www.w3.org/ns/activitystreams',
+            'id': '{}/as/collection.json'.format(self.base_url),
+            'type': 'OrderedCollection',
+            'totalItems': self.pages * self.activities,
+            'first': {
+                'id': '{}/as/page/0.json'.format(self.base_url),
+                'type': 'OrderedCollectionPage'
+                },
+            'last': {
+                'id': '{}/as/page/{}.json'.format(self.base_url,
+                                                  self.pages - 1),
+                'type': 'OrderedCollectionPage'
+                }
+            }
+
+    def page(self, p):
+        items = []
+        for a in range(self.activities):
+            n = p * self.activities + a
+            items.append({
+                'id': '{}/as/activity/{}'.format(self.base_url, n),
+                'type': 'Create',
+                'endTime': (self.start_time +
+                            datetime.timedelta(seconds=n)).isoformat(),
+                'object': {
+                    '@id': '{}/curation/{}.json'.format(self.base_url, n),
+                    '@type': 'cr:Curation'
+                    }
+                })
+        page = {
+            '@context': 'https://www.w3.org/ns/activitystreams',
+            'id': '{}/as/page/{}.json'.format(self.base_url, p),
+            'type': 'OrderedCollectionPage',
+            'orderedItems': items
+            }
+        if p > 0:
+            page['prev'] = {
+                'id': '{}/as/page/{}.json'.format(self.base_url, p - 1),
+                'type': 'OrderedCollectionPage'
+                }
+        return page
+
+    def curation(self, n):
+        rand = random.Random('{}-{}'.format(self.seed, n))
+        selections = []
+        for s in range(self.selections):
+            m = rand.randrange(self.manifests)
+            members = []
+            for _ in range(self.cutouts):
+                w = rand.randint(10, IMAGE_SIZE // 4)
+                h = rand.randint(10, IMAGE_SIZE // 4)
+                members.append({
+                    '@id': '{}#xywh={},{},{},{}'.format(
+                        self.canvas_uri(m, rand.randrange(self.canvases)),
+                        rand.randrange(IMAGE_SIZE - w),
+                        rand.randrange(IMAGE_SIZE - h),
+                        w,
+                        h
+                        ),
+                    '@type': 'sc:Canvas',
+                    'label': 'Cutout'
+                    })
+            selections.append({
+                '@id': '{}/curation/{}/range/{}'.format(self.base_url, n, s),
+                '@type': 'sc:Range',
+                'label': 'Selection {}'.format(s),
+                'members': members,
+                'within': {
+                    '@id': self.manifest_uri(m),
+                    '@type': 'sc:Manifest'
+                    }
+                })
+        return {
+            '@context': ['http://iiif.io/api/presentation/2/context.json',
+                         'http://codh.rois.ac.jp/iiif/curation/1/context.json'],
+            '@id': '{}/curation/{}.json'.format(self.base_url, n),
+            '@type': 'cr:Curation',
+            'label': 'Curation {}'.format(n),
+            'selections': selections
+            }
+
+    def document(self, path):
+        """ Return the document for a URL path, or None.
+        """
+
+        parts = path.strip('/').replace('.json', '').split('/')
+        try:
+            if parts == ['as', 'collection']:
+                return self.collection()
+            if parts[:2] == ['as', 'page']:
+                return self.page(int(parts[2]))
+            if parts[0] == 'curation':
+                return self.curation(int(parts[1]))
+        except (IndexError, ValueError):
+            pass
+        return None
+
+
+def serve(*streams):
+    """ Serve Activity Streams in a background thread. Return the server.
+        Several streams are told apart by the paths of their base URLs
+        (which have to be set before the first request).
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = urllib.parse.urlsplit(self.path).path
+            doc = None
+            for stream in streams:
+                prefix = urllib.parse.urlsplit(stream.base_url).path
+                if path.startswith(prefix + '/'):
+                    doc = stream.document(path[len(prefix):])
+                    break
+            if doc is None:
+                self.send_error(404)
+                return
+            body = json.dumps(doc).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def percentile(sorted_vals, p):
+    """ Nearest-rank percentile of a sorted list.
+    """
+
+    if not sorted_vals:
+        return None
+    rank = max(1, math.ceil(p / 100 * len(sorted_vals)))
+    return sorted_vals[rank - 1]
+
+
+def empty_db(db_engine):
+    """ Empty all tables created by the migrations (except schema_migrations)
+        and reset the crawl generation.
+    """
+
+    from migrations import init_crawl_generation
+    with db_engine.begin() as db_conn:
+        db_conn.execute('''
+            TRUNCATE curation_elements, curations, canvases,
+                last_activity_times, crawl_generation, crawl_stats,
+                analytics_dirty_canvases, canvas_stats, manifest_stats,
+                canvas_heatmaps, crawl_checkpoints, crawl_checkpoint_objects,
+                dereference_retries
+            RESTART IDENTITY CASCADE''')
+        init_crawl_generation(db_conn)
+
+
+def bench_crawl(stream, db_engine):
+    from crawler import crawl_single
+    as_url = '{}/as/collection.json'.format(stream.base_url)
+    start = time.perf_counter()
+    crawl_single(as_url, db_engine)
+    seconds = time.perf_counter() - start
+    activities = stream.pages * stream.activities
+    elements = db_engine.execute(
+        'SELECT count(*) FROM curation_elements'
+        ).scalar()
+    return {
+        'seconds': seconds,
+        'activities': activities,
+        'elements': elements,
+        'activities_per_second': activities / seconds,
+        'elements_per_second': elements / seconds,
+        }
+
+
+def check_host_limit(streams, db_engine, limit, timeout):
+    """ Crawl the given Activity Streams (served from the same host) at once,
+        with the given crawl_per_host_limit. Return the number of seconds it
+        took, or None if the crawls didn't finish within timeout seconds.
+    """
+
+    import crawler
+    get_cfg().cfg['crawl_per_host_limit'] = limit
+    crawler._host_semaphores.clear()
+    empty_db(db_engine)
+    threads = [
+        threading.Thread(
+            target=crawler.crawl_single,
+            args=('{}/as/collection.json'.format(stream.base_url), db_engine),
+            daemon=True
+            )
+        for stream in streams]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(max(0, timeout - (time.perf_counter() - start)))
+        if thread.is_alive():
+            return None
+    return time.perf_counter() - start
+
+
+def bench_queries(stream, n_queries, concurrency, area_ratio, seed=0):
+    import tracer
+    rand = random.Random(seed)
+    canvas_uris = stream.all_canvas_uris()
+    urls = []
+    for _ in range(n_queries):
+        params = {'canvas': rand.choice(canvas_uris)}
+        if rand.random() < area_ratio:
+            x = rand.randrange(IMAGE_SIZE)
+            y = rand.randrange(IMAGE_SIZE)
+            params['xywh'] = '{},{},{},{}'.format(
+                x, y, rand.randint(1, IMAGE_SIZE - x),
+                rand.randint(1, IMAGE_SIZE - y)
+                )
+        urls.append('/?' + urllib.parse.urlencode(params))
+    local = threading.local()
+
+    def timed_get(url):
+        if not hasattr(local, 'client'):
+            local.client = tracer.app.test_client()
+        start = time.perf_counter()
+        resp = local.client.get(url)
+        seconds = time.perf_counter() - start
+        return seconds, resp.status_code
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(timed_get, urls))
+    seconds = time.perf_counter() - start
+    latencies = sorted(res[0] * 1000 for res in results)
+    return {
+        'queries': n_queries,
+        'concurrency': concurrency,
+        'errors': len([res for res in results if res[1] != 200]),
+        'seconds': seconds,
+        'queries_per_second': n_queries / seconds,
+        'latency_ms': {
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99),
+            'max': latencies[-1] if latencies else None,
+            },
+        }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=REPO_DIR,
+            stderr=subprocess.DEVNULL
+            ).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark crawling and trace queries.'
+        )
+    parser.add_argument('--db-uri', required=True,
+                        help='PostGIS DB to use (will be emptied)')
+    parser.add_argument('--pages', type=int, default=10,
+                        help='Activity Stream pages (default: 10)')
+    parser.add_argument('--activities', type=int, default=100,
+                        help='activities per page (default: 100)')
+    parser.add_argument('--selections', type=int, default=2,
+                        help='selections per Curation (default: 2)')
+    parser.add_argument('--cutouts', type=int, default=10,
+                        help='cutouts per selection (default: 10)')
+    parser.add_argument('--manifests', type=int, default=20,
+                        help='number of manifests (default: 20)')
+    parser.add_argument('--canvases', type=int, default=50,
+                        help='canvases per manifest (default: 50)')
+    parser.add_argument('--queries', type=int, default=2000,
+                        help='number of trace queries (default: 2000)')
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='concurrent trace queries (default: 4)')
+    parser.add_argument('--area-ratio', type=float, default=0.5,
+                        help='share of trace queries with an xywh area '
+                             '(default: 0.5)')
+    parser.add_argument('--query-cache', action='store_true',
+                        help='keep the configured query cache enabled '
+                             '(default: disabled)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--check-host-limit', action='store_true',
+                        help='only check that crawls of two Activity Streams '
+                             'on the same host finish')
+    parser.add_argument('--timeout', type=float, default=300,
+                        help='seconds after which --check-host-limit fails '
+                             '(default: 300)')
+    parser.add_argument('--output', default='benchmark_results.json',
+                        help='file the results are written to '
+                             '(default: benchmark_results.json)')
+    args = parser.parse_args()
+
+    streams = [
+        SyntheticActivityStream(None, args.pages, args.activities,
+                                args.selections, args.cutouts, args.manifests,
+                                args.canvases, args.seed + i)
+        for i in range(2 if args.check_host_limit else 1)]
+    server = serve(*streams)
+    host_url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    if args.check_host_limit:
+        for i, stream in enumerate(streams):
+            stream.base_url = '{}/{}'.format(host_url, i)
+    else:
+        stream, = streams
+        stream.base_url = host_url
+
+    # settings overridden for the benchmark (not written to config.ini)
+    cfg = get_cfg()
+    cfg.cfg['db_uri'] = args.db_uri
+    cfg.cfg['activity_stream_list'] = []
+    cfg.cfg['crawl_embedded'] = False
+    cfg.cfg['http_cache_dir'] = ''
+    cfg.cfg['query_cache_generation_check'] = 0
+    if not args.query_cache:
+        cfg.cfg['query_cache_backend'] = 'none'
+
+    from crawler import db_setup
+    db_engine = db_setup(args.db_uri)
+    if args.check_host_limit:
+        for limit in [1, 2]:
+            seconds = check_host_limit(streams, db_engine, limit,
+                                       args.timeout)
+            if seconds is None:
+                # (the crawls keep waiting in daemon threads)
+                print('crawl_per_host_limit {}: crawls did not finish within '
+                      '{:.0f}s'.format(limit, args.timeout))
+                sys.exit(1)
+            print('crawl_per_host_limit {}: crawls finished in '
+                  '{:.1f}s'.format(limit, seconds))
+        sys.exit(0)
+    empty_db(db_engine)
+
+    results = {
+        'revision': git_revision(),
+        'time': datetime.datetime.utcnow().isoformat(),
+        'parameters': {key: val for key, val in vars(args).items()
+                       if key != 'db_uri'},
+        'query_backend': cfg.query_backend,
+        }
+    print('Crawling {} activities ...'.format(args.pages * args.activities))
+    results['crawl'] = bench_crawl(stream, db_engine)
+    print('  {activities_per_second:.1f} activities/s, '
+          '{elements_per_second:.1f} elements/s ({seconds:.1f}s)'.format(
+              **results['crawl']))
+    print('Querying {} times ({} concurrently) ...'.format(args.queries,
+                                                         args.concurrency))
+    results['queries'] = bench_queries(stream, args.queries,
+                                       args.concurrency, args.area_ratio,
+                                       args.seed)
+    print('  {queries_per_second:.1f} queries/s, {errors} errors'.format(
+        **results['queries']))
+    print('  latency p50 {p50:.1f}ms, p95 {p95:.1f}ms, p99 {p99:.1f}ms'.format(
+        **results['queries']['latency_ms']))
+    server.shutdown()
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('Results written to {}'.format(args.output))
@@ -0,0 +1,179 @@
+""" Micro-benchmark of the trace endpoint's response building.
+
+    Compares the previous builder (OrderedDicts, copy.deepcopy and a UUID per
+    annotation, serialized by flask.jsonify with sorted keys) with the one in
+    builder.py for a canvas with a given number of backlinked areas. Reports
+    requests per second on a single core.
+
+    Usage:
+        python3 benchmarks/response_builder.py [<areas> [<backlinks>]]
+"""
+
+import copy
+import json
+import os
+import sys
+import time
+import uuid
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+import builder  # noqa: E402
+from config import get_cfg  # noqa: E402
+
+
+# previous implementation, kept as is for comparison
+
+
+def legacy_build_canvas_member(canvas_uri, backlinks, q_hash, base_url):
+    cfg = get_cfg()
+    curation_link_prefix = cfg.curation_link_prefix
+    if len(curation_link_prefix) > 0:
+        use_prefix = True
+    else:
+        use_prefix = False
+    marker_settings = cfg.marker_settings
+
+    mem = OrderedDict()
+    mem['@id'] = canvas_uri
+    mem['@type'] = 'sc:Canvas'
+    mem['label'] = 'Temporary canvas for displaying annotations'
+    mem['metadata'] = []
+    for xywh, uris in backlinks.items():
+        mtd = OrderedDict()
+        mtd['label'] = 'Annotation'
+        mtd['value'] = []
+        ann = OrderedDict()
+        ann['@id'] = '{}/trace/{}/annotation/{}'.format(
+            base_url, q_hash, uuid.uuid1()
+            )
+        ann['@type'] = 'oa:Annotation'
+        ann['motivation'] = 'sc:painting'
+        ann['on'] = '{}#xywh={}'.format(canvas_uri, xywh)
+        ann['resource'] = OrderedDict()
+        ann['resource']['@type'] = 'cnt:ContentAsText'
+        ann['resource']['format'] = 'text/html'
+        backlink_list_chars = ''
+        for i, uri in enumerate(uris):
+            if i > 0:
+                backlink_list_chars += ',<br>'
+            backlink_uri = uri
+            if use_prefix:
+                backlink_uri = '{}{}'.format(
+                    curation_link_prefix,
+                    uri
+                    )
+            backlink_list_chars += '<a href="{}">Curation {}</a>'.format(
+                backlink_uri, i+1
+                )
+        ann['resource']['chars'] = backlink_list_chars
+        ann['resource']['marker'] = OrderedDict()
+        for key, val in marker_settings.items():
+            ann['resource']['marker'][key] = val
+        mtd['value'].append(copy.deepcopy(ann))
+        mem['metadata'].append(copy.deepcopy(mtd))
+    return mem
+
+
+def legacy_build_container_curation(label, containing_manifest_uri, query_url,
+                                    base_url):
+    q_hash = builder.query_hash(query_url)
+
+    cur = OrderedDict()
+    cur['@context'] = ['http://iiif.io/api/presentation/2/context.json',
+                       ('http://codh.rois.ac.jp/iiif/curation/1/context.js'
+                        'on')]
+    cur['@type'] = 'cr:Curation'
+    cur['@id'] = query_url
+    cur['viewingHint'] = 'annotation'
+    cur['label'] = label
+    cur['selections'] = []
+    sel = OrderedDict()
+    sel['@id'] = '{}/trace/{}/range/{}'.format(base_url, q_hash, uuid.uuid1())
+    sel['@type'] = 'sc:Range'
+    sel['label'] = 'Temporary range for displaying a canvas'
+    sel['members'] = []
+    sel['within'] = OrderedDict()
+    sel['within']['@id'] = containing_manifest_uri
+    sel['within']['@type'] = 'sc:Manifest'
+    sel['within']['label'] = 'Temporary manifest for displaying a canvas'
+    cur['selections'].append(sel)
+    return cur, sel
+
+
+def legacy_build_annotation_container_curation(
+    canvas_uri, containing_manifest_uri, backlinks, query_url, base_url
+    ):
+    if base_url[-1] == '/':
+        base_url = base_url[:-1]
+
+    cur, sel = legacy_build_container_curation(
+        'Tracing Curations for {}'.format(canvas_uri),
+        containing_manifest_uri,
+        query_url,
+        base_url)
+    mem = legacy_build_canvas_member(canvas_uri, backlinks,
+                                     builder.query_hash(query_url), base_url)
+    sel['members'].append(copy.deepcopy(mem))
+    return cur
+
+
+def legacy_response(args):
+    # flask.jsonify with its default settings (JSONIFY_PRETTYPRINT_REGULAR
+    # off, JSON_SORT_KEYS on)
+    return json.dumps(legacy_build_annotation_container_curation(*args),
+                      separators=(',', ':'), sort_keys=True).encode('utf-8')
+
+
+def current_response(args):
+    return builder.dumps(builder.build_annotation_container_curation(*args))
+
+
+def make_args(n_areas, n_backlinks):
+    canvas_uri = 'http://example.org/iiif/book1/canvas/p1'
+    backlinks = {}
+    for a in range(n_areas):
+        xywh = '{},{},{},{}'.format(a * 10, a * 7, 100 + a, 80 + a)
+        backlinks[xywh] = [
+            'http://example.org/curation/{}-{}.json'.format(a, b)
+            for b in range(n_backlinks)
+            ]
+    query_url = 'http://localhost:5000/?canvas={}'.format(canvas_uri)
+    return (canvas_uri, 'http://example.org/iiif/book1/manifest', backlinks,
+            query_url, 'http://localhost:5000/')
+
+
+def requests_per_second(func, args, min_time=2):
+    n = 0
+    start = time.perf_counter()
+    elapsed = 0
+    while elapsed < min_time:
+        func(args)
+        n += 1
+        elapsed = time.perf_counter() - start
+    return n / elapsed
+
+
+if __name__ == '__main__':
+    n_areas = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    n_backlinks = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    args = make_args(n_areas, n_backlinks)
+    legacy = json.loads(legacy_response(args).decode('utf-8'))
+    current = json.loads(current_response(args).decode('utf-8'))
+    for resp in (legacy, current):
+        # only the IDs of the range and annotations differ
+        resp['selections'][0]['@id'] = None
+        for mtd in resp['selections'][0]['members'][0]['metadata']:
+            mtd['value'][0]['@id'] = None
+    if legacy != current:
+        print('Responses differ')
+        sys.exit(1)
+    print('{} areas x {} backlinks ({}serializing with orjson)'.format(
+        n_areas, n_backlinks, '' if builder.orjson else 'not '))
+    before = requests_per_second(legacy_response, args)
+    after = requests_per_second(current_response, args)
+    print('before: {:8.1f} requests/s/core'.format(before))
+    print('after:  {:8.1f} requests/s/core ({:.1f}x)'.format(
+        after, after / before))
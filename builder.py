@@ -0,0 +1,279 @@
+""" Building of the Curations returned by the trace endpoint.
+
+    Responses are built in a single pass from plain dicts (which keep their
+    insertion order) without copying, and serialized with dumps().
+"""
+
+import hashlib
+import json
+import urllib.parse
+import uuid
+import dateutil.parser
+from config import get_cfg
+from queries import encode_cursor
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(obj):
+    """ Serialize a response to JSON (bytes). Uses orjson if it is
+        installed.
+    """
+
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False,
+                      separators=(',', ':')).encode('utf-8')
+
+
+def digest(*parts):
+    """ Short digest of strings that is the same in every process (unlike
+        hash()).
+    """
+
+    return hashlib.sha256('\n'.join(parts).encode('utf-8')).hexdigest()[:16]
+
+
+def query_hash(query_url):
+    """ Generate a compact identifier from a query URL. This idenifier is then
+        used for @ids of Ranges and Annotations.
+
+        IIIF URI pattern:
+            {scheme}://{host}/{prefix}/{identifier}/range/{name}
+            {scheme}://{host}/{prefix}/{identifier}/annotation/{name}
+
+        Digests of the query (Ranges) or of the canvas and area (Annotations)
+        are used for {name}, so that identical queries always get identical
+        responses. (Not handled by this function.)
+
+        The return value of this function is used as {identifier} and
+        consistent across one query.
+
+        Example values:
+            query_hash('<tracer_instance>/?canvas=<...>&xywh=<...>')
+            '4adaf0dc94762893'
+    """
+
+    return digest(query_url)
+
+
+def trace_validators(query_url, generation, changed_at):
+    """ Return the ETag and last modification time (or None) of the
+        response to a trace query, given the crawl generation and the time
+        it started (see query_cache.GenerationTracker). Responses only change
+        with the generation or with the settings they are built with.
+    """
+
+    cfg = get_cfg()
+    etag = '{}-{}'.format(generation, digest(
+        query_url,
+        cfg.curation_link_prefix,
+        json.dumps(cfg.marker_settings, sort_keys=True),
+        # defaults of the page arguments (see queries.parse_page_args)
+        str(cfg.trace_page_size),
+        str(cfg.trace_max_page_size),
+        str(cfg.trace_max_backlinks)
+        ))
+    last_modified = None
+    if changed_at:
+        last_modified = dateutil.parser.parse(changed_at)
+    return etag, last_modified
+
+
+class CanvasMemberBuilder():
+    """ Builds canvases annotated with curation backlinks (to be used as
+        members of a range). Settings and ID prefixes are computed once and
+        shared by all canvases of a response.
+    """
+
+    def __init__(self, q_hash, base_url):
+        cfg = get_cfg()
+        self.curation_link_prefix = cfg.curation_link_prefix
+        # shared by all annotations, never modified
+        self.marker = dict(cfg.marker_settings)
+        self.ann_id_prefix = '{}/trace/{}/annotation/'.format(base_url,
+                                                              q_hash)
+
+    def build(self, canvas_uri, backlinks, omitted=None):
+        """ Build a canvas annotated with backlinks (a dict mapping areas to
+            lists of Curation URIs). omitted optionally maps areas to the
+            number of backlinks left out.
+        """
+
+        prefix = self.curation_link_prefix
+        marker = self.marker
+        on_prefix = canvas_uri + '#xywh='
+        metadata = []
+        for xywh, uris in backlinks.items():
+            # For every area a single annotation with a list of all backlinks
+            # to curations
+            chars = ',<br>'.join([
+                '<a href="{}{}">Curation {}</a>'.format(prefix, uri, i)
+                for i, uri in enumerate(uris, 1)
+                ])
+            if omitted and omitted.get(xywh):
+                chars += ',<br>{} more'.format(omitted[xywh])
+            metadata.append({
+                'label': 'Annotation',
+                'value': [{
+                    '@id': self.ann_id_prefix + digest(canvas_uri, xywh),
+                    '@type': 'oa:Annotation',
+                    'motivation': 'sc:painting',
+                    'on': on_prefix + xywh,
+                    'resource': {
+                        '@type': 'cnt:ContentAsText',
+                        'format': 'text/html',
+                        'chars': chars,
+                        'marker': marker
+                        }
+                    }]
+                })
+        return {
+            '@id': canvas_uri,
+            '@type': 'sc:Canvas',
+            'label': 'Temporary canvas for displaying annotations',
+            'metadata': metadata
+            }
+
+
+def build_container_curation(label, containing_manifest_uri, query_url,
+                             base_url, members):
+    """ Build a curation with a single range containing the given members.
+    """
+
+    return {
+        '@context': ['http://iiif.io/api/presentation/2/context.json',
+                     'http://codh.rois.ac.jp/iiif/curation/1/context.json'],
+        '@type': 'cr:Curation',
+        '@id': query_url,
+        'viewingHint': 'annotation',
+        'label': label,
+        'selections': [{
+            '@id': '{}/trace/{}/range/{}'.format(
+                base_url, query_hash(query_url),
+                digest(query_url, containing_manifest_uri)
+                ),
+            '@type': 'sc:Range',
+            'label': 'Temporary range for displaying a canvas',
+            'members': members,
+            'within': {
+                '@id': containing_manifest_uri,
+                '@type': 'sc:Manifest',
+                'label': 'Temporary manifest for displaying a canvas'
+                }
+            }]
+        }
+
+
+def build_annotation_container_curation(
+    canvas_uri, containing_manifest_uri, backlinks, query_url, base_url,
+    omitted=None
+    ):
+    """ Build a curation containing a single canvas that is annotated with
+        curation backlinks (see CanvasMemberBuilder.build).
+    """
+
+    if base_url[-1] == '/':
+        base_url = base_url[:-1]
+
+    member_builder = CanvasMemberBuilder(query_hash(query_url), base_url)
+    return build_container_curation(
+        'Tracing Curations for {}'.format(canvas_uri),
+        containing_manifest_uri,
+        query_url,
+        base_url,
+        [member_builder.build(canvas_uri, backlinks, omitted)])
+
+
+def build_trace_page(canvas_uri, containing_manifest_uri, areas, has_more,
+                     query_url, base_url):
+    """ Build the curation answering a trace query from a page of areas (as
+        returned by backlinks_page of a query backend). Return the curation
+        and the cursor of the next page ('' if there is none).
+    """
+
+    backlinks_by_area = {}
+    omitted = {}
+    for x, y, w, h, uris, n in areas:
+        xywh = '{},{},{},{}'.format(x, y, w, h)
+        backlinks_by_area[xywh] = uris
+        if n > len(uris):
+            omitted[xywh] = n - len(uris)
+    next_cursor = ''
+    if has_more:
+        next_cursor = encode_cursor(*areas[-1][:4])
+    curation = build_annotation_container_curation(
+        canvas_uri,
+        containing_manifest_uri,
+        backlinks_by_area,
+        query_url,
+        base_url,
+        omitted)
+    return curation, next_cursor
+
+
+def next_page_link(base_url, args, cursor):
+    """ Return the value of the Link header pointing to the next page of a
+        trace query, given its query arguments (a dict mapping names to lists
+        of values).
+    """
+
+    args = dict(args)
+    args['cursor'] = [cursor]
+    return '<{}?{}>; rel="next"'.format(
+        base_url,
+        urllib.parse.urlencode(args, doseq=True)
+        )
+
+
+class ManifestCurationJSON():
+    """ Builds the JSON of a curation containing all canvases of a manifest
+        annotated with curation backlinks piece by piece: head(), member()
+        for every canvas and tail() are to be concatenated in this order.
+    """
+
+    def __init__(self, manifest_uri, query_url, base_url):
+        if base_url[-1] == '/':
+            base_url = base_url[:-1]
+
+        placeholder = '__members_{}__'.format(uuid.uuid4().hex)
+        cur = build_container_curation(
+            'Tracing Curations for {}'.format(manifest_uri),
+            manifest_uri,
+            query_url,
+            base_url,
+            placeholder)
+        self.head_json, self.tail_json = dumps(cur).split(dumps(placeholder))
+        self.member_builder = CanvasMemberBuilder(query_hash(query_url),
+                                                  base_url)
+        self.first_member = True
+
+    def head(self):
+        return self.head_json + b'['
+
+    def member(self, canvas_uri, backlinks):
+        member_json = dumps(self.member_builder.build(canvas_uri, backlinks))
+        if self.first_member:
+            self.first_member = False
+            return member_json
+        return b',' + member_json
+
+    def tail(self):
+        return b']' + self.tail_json
+
+
+def iter_manifest_curation_json(manifest_uri, canvas_backlinks, query_url,
+                                base_url):
+    """ Generate the JSON of a curation containing all canvases of a manifest
+        annotated with curation backlinks piece by piece. canvas_backlinks is
+        an iterable of (canvas URI, backlinks) tuples.
+    """
+
+    curation_json = ManifestCurationJSON(manifest_uri, query_url, base_url)
+    yield curation_json.head()
+    for canvas_uri, backlinks in canvas_backlinks:
+        yield curation_json.member(canvas_uri, backlinks)
+    yield curation_json.tail()
@@ -0,0 +1,168 @@
+""" Durable crawl state: checkpoints of unfinished crawls and the queue of
+    Curations to retry.
+
+    A crawl goes through an Activity Stream from its newest page backwards.
+    After every page, the URL of the page to continue with, the time of the
+    newest activity processed and the objects whose activities were
+    processed are stored (tables crawl_checkpoints and
+    crawl_checkpoint_objects), so that a crawl interrupted by a crash or
+    restart continues where it stopped. The checkpoint is removed when the
+    crawl completes.
+
+    Curations that couldn't be retrieved are stored in the table
+    dereference_retries and retried with exponential backoff at the start of
+    later crawls of the same Activity Stream, until they are retrieved, a
+    newer activity about them is processed or crawl_retry_max_attempts is
+    reached (such entries are kept, with next_attempt NULL).
+"""
+
+import datetime
+import dateutil.parser
+from sqlalchemy import text as sqla_text
+from config import get_cfg
+from logger import log, ERROR
+
+
+def load_checkpoint(as_url, db_engine):
+    """ Return the checkpoint of an unfinished crawl of an Activity Stream
+        as a dict, or None if there is none.
+    """
+
+    q = sqla_text('''
+        SELECT next_page, last_activity, data_changed
+        FROM crawl_checkpoints
+        WHERE activity_stream_url=:as_url''')
+    row = db_engine.execute(q, as_url=as_url).fetchone()
+    if not row:
+        return None
+    q_obj = sqla_text('''
+        SELECT object_id
+        FROM crawl_checkpoint_objects
+        WHERE activity_stream_url=:as_url''')
+    last_activity = None
+    if row['last_activity']:
+        last_activity = dateutil.parser.parse(row['last_activity'])
+    return {
+        'next_page': row['next_page'],
+        'last_activity': last_activity,
+        'data_changed': row['data_changed'],
+        'seen_objects': set(obj_row[0] for obj_row
+                            in db_engine.execute(q_obj, as_url=as_url)),
+        }
+
+
+def save_checkpoint(as_url, next_page, last_activity, data_changed,
+                    new_objects, db_conn):
+    """ Store the progress of a crawl after a page was processed. Objects
+        are added to those of previous pages.
+    """
+
+    q = sqla_text('''
+        INSERT INTO crawl_checkpoints(activity_stream_url, next_page,
+                                      last_activity, data_changed, saved_at)
+        VALUES (:as_url, :next_page, :last_activity, :data_changed, :now)
+        ON CONFLICT (activity_stream_url)
+        DO UPDATE SET
+            next_page = EXCLUDED.next_page,
+            last_activity = EXCLUDED.last_activity,
+            data_changed = EXCLUDED.data_changed,
+            saved_at = EXCLUDED.saved_at''')
+    db_conn.execute(
+        q,
+        as_url=as_url,
+        next_page=next_page,
+        last_activity=last_activity.isoformat() if last_activity else None,
+        data_changed=data_changed,
+        now=datetime.datetime.utcnow().isoformat())
+    if not new_objects:
+        return
+    q_obj = sqla_text('''
+        INSERT INTO crawl_checkpoint_objects(activity_stream_url, object_id)
+        SELECT :as_url, unnest(CAST(:objs AS TEXT[]))
+        ON CONFLICT (activity_stream_url, object_id)
+        DO NOTHING''')
+    db_conn.execute(q_obj, as_url=as_url, objs=list(new_objects))
+
+
+def clear_checkpoint(as_url, db_conn):
+    for table in ['crawl_checkpoint_objects', 'crawl_checkpoints']:
+        db_conn.execute(sqla_text('''
+            DELETE FROM {}
+            WHERE activity_stream_url=:as_url'''.format(table)),
+            as_url=as_url)
+
+
+def retry_delay(attempts):
+    """ Return the time to wait before retrying after the given number of
+        failed attempts.
+    """
+
+    cfg = get_cfg()
+    minutes = min(cfg.crawl_retry_base_delay * 2 ** (attempts - 1),
+                  cfg.crawl_retry_max_delay)
+    return datetime.timedelta(minutes=minutes)
+
+
+def enqueue_retry(as_url, url, db_conn):
+    """ Record a failed attempt to retrieve a Curation of an Activity Stream
+        and schedule the next one.
+    """
+
+    q = sqla_text('''
+        SELECT attempts
+        FROM dereference_retries
+        WHERE activity_stream_url=:as_url AND url=:url''')
+    attempts = (db_conn.execute(q, as_url=as_url, url=url).scalar() or 0) + 1
+    now = datetime.datetime.utcnow()
+    max_attempts = get_cfg().crawl_retry_max_attempts
+    if max_attempts and attempts >= max_attempts:
+        log('Giving up on retrieving {} after {} attempts.'.format(
+            url,
+            attempts
+            ), ERROR)
+        next_attempt = None
+    else:
+        next_attempt = (now + retry_delay(attempts)).isoformat()
+    u = sqla_text('''
+        INSERT INTO dereference_retries(activity_stream_url, url, attempts,
+                                        first_failure, last_failure,
+                                        next_attempt)
+        VALUES (:as_url, :url, :attempts, :now, :now, :next_attempt)
+        ON CONFLICT (activity_stream_url, url)
+        DO UPDATE SET
+            attempts = EXCLUDED.attempts,
+            last_failure = EXCLUDED.last_failure,
+            next_attempt = EXCLUDED.next_attempt''')
+    db_conn.execute(u, as_url=as_url, url=url, attempts=attempts,
+                    now=now.isoformat(), next_attempt=next_attempt)
+
+
+def due_retries(as_url, db_engine):
+    """ Return the URLs of the Curations of an Activity Stream whose next
+        retrieval attempt is due.
+    """
+
+    q = sqla_text('''
+        SELECT url
+        FROM dereference_retries
+        WHERE activity_stream_url=:as_url AND next_attempt <= :now
+        ORDER BY next_attempt''')
+    return [row[0] for row in db_engine.execute(
+        q,
+        as_url=as_url,
+        now=datetime.datetime.utcnow().isoformat()
+        )]
+
+
+def forget_retries(as_url, urls, db_conn):
+    """ Remove queued retries (e.g. because they have been superseded by a
+        newer activity).
+    """
+
+    if not urls:
+        return
+    q = sqla_text('''
+        DELETE FROM dereference_retries
+        WHERE activity_stream_url=:as_url
+            AND url = ANY(CAST(:urls AS TEXT[]))''')
+    db_conn.execute(q, as_url=as_url, urls=list(urls))
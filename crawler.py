@@ -1,23 +1,55 @@
+import argparse
 import datetime
 import dateutil.parser
+import io
 import json
 import requests
 import os
+import threading
+import time
+import traceback
+import urllib.parse
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from sqlalchemy import text as sqla_text
-from sqlalchemy import create_engine
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
-from config import Cfg
+from analytics import mark_canvases_dirty, refresh_analytics
+from config import get_cfg, install_sighup_handler
+from crawl_state import clear_checkpoint, due_retries, enqueue_retry
+from crawl_state import forget_retries, load_checkpoint, save_checkpoint
+from db import get_engine
+from http_cache import HTTPCache
+from json_stream import PageStream, parse_curation
+from migrations import migrate
+from queries import AREA_XYWH_COLUMNS
+from logger import log, DEBUG, WARNING, ERROR
+from maintenance import run_maintenance
+from metrics import CrawlStats, record_crawl
+
+# arbitrary but fixed key for pg_try_advisory_lock, held by the one process
+# that crawls (see acquire_crawl_leadership)
+CRAWL_LOCK_ID = 74220002
+
+_host_semaphores = {}
+_host_semaphores_lock = threading.Lock()
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+_http_cache = None
+_http_cache_lock = threading.Lock()
+_leader_conn = None
+_leader_pid = None
+_leader_lock = threading.Lock()
+_last_maintenance = None
 
 
 def requests_retry_session(retries=5, backoff_factor=0.2,
                            status_forcelist=(500, 502, 504),
-                           session=None):
+                           session=None, pool_maxsize=10):
     """ Method to use instead of requests.get to allow for retries during the
-        crawling process. Ideally the crawler should, outside of this method,
-        keep track of resources that could not be dereferenced, and offer some
-        kind of way to retry for those resources at a later point in time (e.g.
-        the next crawling run.
+        crawling process. Curations that still can't be dereferenced are
+        retried in later crawling runs (see crawl_state.py).
 
         Code from and discussion at:
         https://www.peterbe.com/plog/best-practice-with-retries-with-requests
@@ -31,12 +63,32 @@ def requests_retry_session(retries=5, backoff_factor=0.2,
         backoff_factor=backoff_factor,
         status_forcelist=status_forcelist,
     )
-    adapter = HTTPAdapter(max_retries=retry)
+    adapter = HTTPAdapter(max_retries=retry, pool_maxsize=pool_maxsize)
     session.mount('http://', adapter)
     session.mount('https://', adapter)
     return session
 
 
+def host_slot(url):
+    """ Return a semaphore limiting the number of concurrent requests to the
+        host of the given URL (to the configured crawl_per_host_limit).
+
+        Usage:
+            with host_slot(url):
+                resp = requests.get(url)
+
+        (see HostSlotReader for responses whose body is read later)
+    """
+
+    host = urllib.parse.urlsplit(url).netloc
+    with _host_semaphores_lock:
+        if host not in _host_semaphores:
+            _host_semaphores[host] = threading.BoundedSemaphore(
+                get_cfg().crawl_per_host_limit
+                )
+        return _host_semaphores[host]
+
+
 def get_attrib_uri(json_dict, attrib):
     """ Get the URI for an attribute.
     """
@@ -52,94 +104,341 @@ def get_attrib_uri(json_dict, attrib):
     return url
 
 
-def get_referenced(json_dict, attrib):
-    """ Get a value (of an attribute in a dict) that is not included in its
-        entirety but just referenced by a URI or an object with a URI as its
-        id.
+def http_session():
+    """ Return this process' HTTP session. It is shared by all crawling
+        threads so that connections to the same host are kept alive and
+        reused.
     """
 
-    url = get_attrib_uri(json_dict, attrib)
+    global _session, _session_pid
+
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            _session = requests_retry_session(
+                pool_maxsize=get_cfg().crawl_fetch_concurrency
+                )
+            _session_pid = os.getpid()
+        return _session
+
 
+def http_cache():
+    """ Return this process' HTTP cache, or None if caching is disabled.
+    """
+
+    global _http_cache
+
+    cfg = get_cfg()
+    if not cfg.http_cache_dir:
+        return None
+    with _http_cache_lock:
+        if _http_cache is None or _http_cache.directory != cfg.http_cache_dir:
+            _http_cache = HTTPCache(
+                cfg.http_cache_dir,
+                cfg.http_cache_max_mb * 1024 * 1024
+                )
+        return _http_cache
+
+
+class HostSlotReader():
+    """ Binary file object for the body of a response that holds the slot
+        of its host (see host_slot) until it is closed, so that bodies
+        downloaded while they are read count against crawl_per_host_limit.
+
+        A reader must not be left open while waiting for another request to
+        the same host (which may need the slot), see fetch_page.
+    """
+
+    def __init__(self, f, slot):
+        self.f = f
+        self.slot = slot
+
+    def read(self, size=-1):
+        return self.f.read(size)
+
+    def close(self):
+        slot, self.slot = self.slot, None
+        if slot is None:
+            return
+        try:
+            self.f.close()
+        finally:
+            slot.release()
+
+
+def http_get(url):
+    """ GET a URL through the shared session and (if enabled) the HTTP cache.
+        The body is downloaded as it is read (and written to the cache
+        meanwhile).
+    """
+
+    cache = http_cache()
+    if cache is None:
+        return http_session().get(url, stream=True)
+    return cache.get(http_session(), url)
+
+
+def http_stream(url):
+    """ GET a URL and return a binary file object from which its body can be
+        read while it is being downloaded. The file has to be closed, which
+        frees the host's slot (see host_slot).
+    """
+
+    slot = host_slot(url)
+    slot.acquire()
     try:
-        resp = requests_retry_session().get(url)
+        resp = http_get(url)
+        if resp.status_code != 200:
+            resp.close()
+            raise requests.exceptions.HTTPError(
+                'HTTP {}'.format(resp.status_code)
+                )
+    except Exception:
+        slot.release()
+        raise
+    if isinstance(resp, requests.Response):
+        # undo Content-Encoding (as resp.content would)
+        resp.raw.decode_content = True
+    return HostSlotReader(resp.raw, slot)
+
+
+def _dereference_failed(url, e, stats):
+    log('Could not dereference resource at {}. Error {}.'.format(
+        url,
+        e.__class__.__name__
+        ), WARNING
+    )
+    if stats is not None:
+        stats.increment('dereference_failures')
+
+
+def fetch_page(url, stats=None):
+    """ Retrieve an Activity Stream page. Return a json_stream.PageStream
+        (parsed while its activities are iterated over) or None if it
+        couldn't be retrieved. Failures are counted in stats (a
+        metrics.CrawlStats) if given.
+
+        The page is downloaded completely before it is returned, so that it
+        doesn't hold its host's slot while it waits to be processed: the
+        next page is prefetched while the Curations of the current one are
+        retrieved from the same host, which would deadlock once the
+        prefetched pages of all crawls hold all slots.
+    """
+
+    log('Retrieving {}'.format(url), DEBUG)
+    try:
+        f = http_stream(url)
+        try:
+            body = io.BytesIO(f.read())
+        finally:
+            f.close()
+        return PageStream(url, body)
     except Exception as e:
-        log('Could not dereference resource at {}. Error {}.'.format(
-            url,
-            e.__class__.__name__
-            )
-        )
-        return '{}'
+        _dereference_failed(url, e, stats)
+        return None
+
 
-    return resp.json()
+def fetch_curation(url, stats=None):
+    """ Retrieve and parse a Curation. Return a tuple (Curation URI, content
+        hash, elements) (see json_stream.parse_curation) or None if it
+        couldn't be retrieved. Failures are counted in stats (a
+        metrics.CrawlStats) if given.
+    """
+
+    log('Retrieving curation {}'.format(url))
+    try:
+        f = http_stream(url)
+        try:
+            return parse_curation(f)
+        finally:
+            f.close()
+    except Exception as e:
+        _dereference_failed(url, e, stats)
+        return None
 
 
-def process_curation_create(activity, db_engine):
-    """ Process a create activity that has a cr:Curation as its object.
+def process_curation_create(activity, db_engine, curation=None):
+    """ Process a create or update activity that has a cr:Curation as its
+        object. The Curation is retrieved unless it is passed as curation (as
+        returned by fetch_curation). Return the numbers of inserted and
+        deleted Curation elements.
     """
 
-    new_canvases = 0
-    log('Retrieving curation {}'.format(activity['object']['@id']))
-    cur_dict = get_referenced(activity, 'object')
-    cur_id = cur_dict['@id']
-    index_curation(cur_id, db_engine)
-    log('Entering ranges')
-    for ran in cur_dict.get('selections', []):
-        manifest_id = get_attrib_uri(ran, 'within')
-        canvases = ran.get('members', []) + ran.get('canvases', [])
-        canvas_id_region_tups = [can['@id'].split('#') for can in canvases]
-        # DB entries
-        for can_id_region_tup in canvas_id_region_tups:
-            can_id = can_id_region_tup[0]
-            xywh = can_id_region_tup[1].replace('xywh=', '')
-            index_canvas(can_id, manifest_id, db_engine)
-            index_curation_element(cur_id, can_id, manifest_id, xywh, db_engine)
-        log('done')
-    return len(canvas_id_region_tups)
-
-
-def index_canvas(uri, manifest_uri, db_engine):
-    q = sqla_text('''
-        INSERT INTO canvases(jsonld_id, manifest_jsonld_id)
-        VALUES (:cid, :mid)
-        ON CONFLICT (jsonld_id, manifest_jsonld_id)
-        DO NOTHING''')
-    db_engine.execute(q, cid=uri, mid=manifest_uri)
+    if curation is None:
+        cur_url = get_attrib_uri(activity, 'object')
+        curation = fetch_curation(cur_url)
+        if curation is None:
+            raise RuntimeError('Could not retrieve Curation {}'.format(
+                cur_url
+                ))
+    cur_id, content_hash, elements = curation
+    with db_engine.begin() as db_conn:
+        inserted, deleted = update_curation_elements(
+            cur_id,
+            content_hash,
+            elements,
+            db_conn
+            )
+    log('{} curation elements, {} inserted, {} deleted'.format(
+        len(elements), inserted, deleted
+        ), DEBUG)
+    return inserted, deleted
 
 
-def index_curation(uri, db_engine):
-    q = sqla_text('''
+def index_curation(uri, db_conn):
+    """ Insert a Curation if it doesn't exist yet and return its DB ID.
+    """
+
+    q_ins = sqla_text('''
         INSERT INTO curations(jsonld_id)
         VALUES (:cid)
         ON CONFLICT (jsonld_id)
-        DO NOTHING''')
-    db_engine.execute(q, cid=uri)
+        DO NOTHING
+        RETURNING id''')
+    row = db_conn.execute(q_ins, cid=uri).fetchone()
+    if row is None:
+        # already there, possibly committed by a concurrent crawl after the
+        # INSERT's snapshot was taken, so it's looked up in a new statement
+        q_sel = sqla_text('''
+            SELECT id
+            FROM curations
+            WHERE jsonld_id=:cid''')
+        row = db_conn.execute(q_sel, cid=uri).fetchone()
+    return row[0]
+
+
+def index_canvases(canvas_manifest_tups, db_conn):
+    """ Insert (canvas URI, manifest URI) pairs that don't exist yet and
+        return a dict mapping all given pairs to their DB IDs.
+    """
+
+    if not canvas_manifest_tups:
+        return {}
+    # inserted in a fixed order, so that concurrent crawls inserting the same
+    # canvases don't deadlock
+    pairs = sorted(set(canvas_manifest_tups))
+    cids, mids = zip(*pairs)
+    q_ins = sqla_text('''
+        INSERT INTO canvases(jsonld_id, manifest_jsonld_id)
+        SELECT cid, mid
+        FROM unnest(CAST(:cids AS TEXT[]), CAST(:mids AS TEXT[]))
+            AS t(cid, mid)
+        ORDER BY cid, mid
+        ON CONFLICT (jsonld_id, manifest_jsonld_id)
+        DO NOTHING
+        RETURNING id, jsonld_id, manifest_jsonld_id''')
+    rows = db_conn.execute(q_ins, cids=list(cids), mids=list(mids))
+    can_db_ids = {(row[1], row[2]): row[0] for row in rows}
+    missing = [pair for pair in pairs if pair not in can_db_ids]
+    if missing:
+        # existing canvases are looked up in a new statement, which also sees
+        # those committed by concurrent crawls after the INSERT's snapshot
+        cids, mids = zip(*missing)
+        q_sel = sqla_text('''
+            SELECT canvases.id, canvases.jsonld_id,
+                canvases.manifest_jsonld_id
+            FROM canvases
+            JOIN unnest(CAST(:cids AS TEXT[]), CAST(:mids AS TEXT[]))
+                AS t(cid, mid)
+            ON canvases.jsonld_id = t.cid
+                AND canvases.manifest_jsonld_id = t.mid''')
+        for row in db_conn.execute(q_sel, cids=list(cids), mids=list(mids)):
+            can_db_ids[(row[1], row[2])] = row[0]
+    return can_db_ids
+
+
+def insert_curation_elements(cur_db_id, elements, db_conn):
+    """ Insert Curation elements (as returned by fetch_curation) of the
+        Curation with the given DB ID. Canvases are upserted in one statement
+        and all elements are inserted in one statement.
+    """
 
+    if not elements:
+        return
+    can_db_ids = index_canvases([el[:2] for el in elements], db_conn)
+    # polygon vertex order (x y, x+w y, x+w y+h, x y+h) is relied upon when
+    # reading areas back
+    q = sqla_text('''
+        INSERT INTO curation_elements(canvas_id, curation_id, area)
+        SELECT can_id, :cur_id, ST_MakePolygon(ST_MakeLine(ARRAY[
+            ST_MakePoint(x, y),
+            ST_MakePoint(x+w, y),
+            ST_MakePoint(x+w, y+h),
+            ST_MakePoint(x, y+h),
+            ST_MakePoint(x, y)]))
+        FROM unnest(CAST(:can_ids AS INTEGER[]), CAST(:xs AS INTEGER[]),
+                    CAST(:ys AS INTEGER[]), CAST(:ws AS INTEGER[]),
+                    CAST(:hs AS INTEGER[]))
+            AS t(can_id, x, y, w, h)''')
+    db_conn.execute(
+        q,
+        cur_id=cur_db_id,
+        can_ids=[can_db_ids[el[:2]] for el in elements],
+        xs=[el[2] for el in elements],
+        ys=[el[3] for el in elements],
+        ws=[el[4] for el in elements],
+        hs=[el[5] for el in elements])
+    mark_canvases_dirty(can_db_ids.values(), db_conn)
+
+
+def update_curation_elements(cur_id, content_hash, elements, db_conn):
+    """ Bring the indexed elements of a Curation in line with the given ones
+        (as returned by fetch_curation) by inserting and deleting only
+        what changed. Nothing is done if the Curation's content_hash is
+        unchanged. Should be called within a transaction. Return the numbers
+        of inserted and deleted elements.
+    """
 
-def index_curation_element(cur_id, can_id, manifest_id, xywh, db_engine):
-    s_cur = sqla_text('''
-        SELECT id
+    cur_db_id = index_curation(cur_id, db_conn)
+    # lock the Curation's row so that concurrent updates are serialized
+    q_hash = sqla_text('''
+        SELECT content_hash
         FROM curations
-        WHERE jsonld_id=:cid''')
-    cur_db_id = db_engine.execute(s_cur, cid=cur_id).fetchone()[0]
-    s_can = sqla_text('''
-        SELECT id
-        FROM canvases
-        WHERE jsonld_id=:cid AND manifest_jsonld_id=:mid''')
-    can_db_id = db_engine.execute(s_can, cid=can_id, mid=manifest_id).fetchone()[0]
-    x, y, w, h = [int(elem) for elem in xywh.split(',')]
-    poly = ('ST_GeomFromText('
-        '\'POLYGON(({} {}, {} {}, {} {}, {} {}, {} {}))\')').format(
-        x, y,
-        x+w, y,
-        x+w, y+h,
-        x, y+h,
-        x, y
-        )
-    # because the IDs are only numbers and the PostGIS polygon won't go
-    # through sqla_text we use format here ¯\_(ツ)_/¯
-    q = '''INSERT INTO curation_elements(canvas_id, curation_id, area)
-        VALUES ({}, {}, {})'''.format(can_db_id, cur_db_id, poly)
-    db_engine.execute(q)
+        WHERE id=:cur_id
+        FOR UPDATE''')
+    old_hash = db_conn.execute(q_hash, cur_id=cur_db_id).scalar()
+    if old_hash == content_hash:
+        return 0, 0
+    q_cel = sqla_text('''
+        SELECT cue.id, canvases.jsonld_id, canvases.manifest_jsonld_id,
+            x, y, w, h
+        FROM
+            (SELECT id, canvas_id, {}
+            FROM curation_elements
+            WHERE curation_id=:cur_id) as cue
+        JOIN canvases
+        ON canvases.id = cue.canvas_id'''.format(AREA_XYWH_COLUMNS))
+    old_elements = {}  # element -> [DB IDs]
+    for row in db_conn.execute(q_cel, cur_id=cur_db_id):
+        old_elements.setdefault(tuple(row[1:]), []).append(row[0])
+    # elements can occur more than once in a Curation, so they are compared
+    # as multisets
+    new_counts = Counter(elements)
+    delete_ids = []
+    for element, db_ids in old_elements.items():
+        surplus = len(db_ids) - new_counts.get(element, 0)
+        if surplus > 0:
+            delete_ids.extend(db_ids[:surplus])
+    insert_elements = []
+    for element, count in new_counts.items():
+        missing = count - len(old_elements.get(element, []))
+        if missing > 0:
+            insert_elements.extend([element] * missing)
+    if delete_ids:
+        d_cel = sqla_text('''
+            DELETE FROM curation_elements
+            WHERE id = ANY(CAST(:ids AS INTEGER[]))
+            RETURNING canvas_id''')
+        mark_canvases_dirty(
+            [row[0] for row in db_conn.execute(d_cel, ids=delete_ids)],
+            db_conn
+            )
+    insert_curation_elements(cur_db_id, insert_elements, db_conn)
+    u_hash = sqla_text('''
+        UPDATE curations
+        SET content_hash=:content_hash
+        WHERE id=:cur_id''')
+    db_conn.execute(u_hash, content_hash=content_hash, cur_id=cur_db_id)
+    return len(insert_elements), len(delete_ids)
 
 
 def deintex_curation(cur_uri, db_engine):
@@ -154,14 +453,19 @@ def deintex_curation(cur_uri, db_engine):
         # delete Curation elements ("cutouts")
         d_cel = sqla_text('''
             DELETE FROM curation_elements
-            WHERE curation_id=:cdbid''')
-        db_engine.execute(d_cel, cdbid=cur_db_id)
+            WHERE curation_id=:cdbid
+            RETURNING canvas_id''')
+        with db_engine.begin() as db_conn:
+            mark_canvases_dirty(
+                [row[0] for row in db_conn.execute(d_cel, cdbid=cur_db_id)],
+                db_conn
+                )
         # delete Curation
         d_cur = sqla_text('''
             DELETE FROM curations
             WHERE jsonld_id=:jid''')
         db_engine.execute(d_cur, jid=cur_uri)
-        # TODO delete orphaned Canvases
+        # orphaned canvases are deleted by maintenance.run_maintenance
 
 
 def process_curation_delete(activity, db_engine):
@@ -173,10 +477,45 @@ def process_curation_delete(activity, db_engine):
     deintex_curation(cur_uri, db_engine)
 
 
-def crawl_single(as_url, db_engine):
-    """ Crawl, given a URL to an Activity Stream
+def retry_dereferences(as_url, db_engine, stats):
+    """ Retry retrieving the Curations of an Activity Stream that couldn't
+        be retrieved before and whose retry is due. Return whether data
+        changed.
+    """
+
+    urls = due_retries(as_url, db_engine)
+    if not urls:
+        return False
+    log('Retrying {} Curation(s) of {}'.format(len(urls), as_url))
+    data_changed = False
+    with ThreadPoolExecutor(get_cfg().crawl_fetch_concurrency) as executor:
+        curations = executor.map(fetch_curation, urls, [stats] * len(urls))
+        for url, curation in zip(urls, curations):
+            with db_engine.begin() as db_conn:
+                if curation is None:
+                    enqueue_retry(as_url, url, db_conn)
+                    continue
+                inserted, deleted = update_curation_elements(*curation,
+                                                             db_conn)
+                forget_retries(as_url, [url], db_conn)
+            if inserted or deleted:
+                data_changed = True
+    return data_changed
+
+
+def crawl_single(as_url, db_engine, stats=None):
+    """ Crawl, given a URL to an Activity Stream. Return False if the
+        Activity Stream couldn't be accessed. Counts are collected in stats
+        (a metrics.CrawlStats) if given.
+
+        Progress is saved after every page, so that an interrupted crawl is
+        continued by the next one (see crawl_state.py). Changes are made
+        visible (see finish_data_changes) also if the crawl fails.
     """
 
+    if stats is None:
+        stats = CrawlStats()
+
     last_activity_query = sqla_text('''
         SELECT last_activity
         FROM last_activity_times
@@ -190,83 +529,219 @@ def crawl_single(as_url, db_engine):
 
     if not last_activity_db:
         last_activity_time_db = datetime.datetime.fromtimestamp(0)
-        log('First time crawling this Activity Stream.')
+        log('First time crawling Activity Stream {}.'.format(as_url))
     else:
         last_activity_time_db = dateutil.parser.parse(last_activity_db[0])
-        log('Last cralwed activity at {}.'.format(last_activity_time_db))
+        log('Last cralwed activity of {} at {}.'.format(
+            as_url,
+            last_activity_time_db
+            ))
 
-    log('Retrieving Activity Stream ({})'.format(as_url))
+    data_changed = False
     try:
-        resp = requests.get(as_url)
-    except requests.exceptions.RequestException as e:
-        msg = 'Could not access Activity Stream. ({})'.format(e)
-        log(msg)
-        print(msg)
-        return
-    if resp.status_code != 200:
-        msg = ('Could not access Activity Stream. (HTTP {})'
-              ).format(resp.status_code)
-        log(msg)
-        print(msg)
-        return
+        data_changed = retry_dereferences(as_url, db_engine, stats)
+
+        as_ocp = None
+        checkpoint = load_checkpoint(as_url, db_engine)
+        if checkpoint:
+            log('Resuming interrupted crawl of {} at {}'.format(
+                as_url,
+                checkpoint['next_page']
+                ))
+            as_ocp = fetch_page(checkpoint['next_page'], stats)
+            if as_ocp is None:
+                log('Could not resume crawl of {}, starting over.'.format(
+                    as_url
+                    ), WARNING)
+                with db_engine.begin() as db_conn:
+                    clear_checkpoint(as_url, db_conn)
+                checkpoint = None
+
+        if checkpoint is None:
+            log('Retrieving Activity Stream ({})'.format(as_url))
+            try:
+                as_oc_f = http_stream(as_url)
+            except requests.exceptions.RequestException as e:
+                msg = 'Could not access Activity Stream {}. ({})'.format(
+                    as_url,
+                    e
+                    )
+                log(msg, WARNING)
+                print(msg)
+                stats.increment('dereference_failures')
+                return False
+
+            # (the collection itself is small, pages and Curations are
+            # streamed)
+            try:
+                as_oc = json.loads(as_oc_f.read().decode('utf-8'))
+            finally:
+                as_oc_f.close()
+            log('Start iterating over Activity Stream pages')
+            as_ocp = fetch_page(get_attrib_uri(as_oc, 'last'), stats)
+
+        new_canvases = 0
+        # NOTE: seen_activity_objs is used to prevent processing obsolete
+        #       activities. Since we go through the Activity Stream
+        #       backwards, we only process the most recent Activity per IIIF
+        #       doc. (Not doing so might lead to for example trying to
+        #       process a Create for a document for which a Delete was
+        #       processed just before.) It contains the IDs of the objects.
+        seen_activity_objs = set()
+        last_activity_time_as = None
+        if checkpoint:
+            seen_activity_objs = checkpoint['seen_objects']
+            last_activity_time_as = checkpoint['last_activity']
+            data_changed = data_changed or checkpoint['data_changed']
+        cfg = get_cfg()
+        with ThreadPoolExecutor(cfg.crawl_fetch_concurrency) as fetch_executor:
+            # for all AS pages
+            while True:
+                if as_ocp is None:
+                    raise RuntimeError('Could not retrieve an Activity Stream '
+                                       'page of {}'.format(as_url))
+                # for all AC items
+                log('going through AS page {}'.format(as_ocp.url))
+                stats.increment('pages')
+                # (activity, future of its Curation) tuples
+                page_activities = []
+                page_has_new = False
+                try:
+                    # activities are parsed one at a time while the page is
+                    # downloaded
+                    for activity in as_ocp.activities():
+                        if activity['type'] in ['Create', 'Update', 'Delete']:
+                            # Reduce noise
+                            log('going through {} item {}'.format(
+                                activity['type'],
+                                activity['id']
+                                ), DEBUG)
+                        activity_end_time = dateutil.parser.parse(
+                            activity['endTime']
+                            )
+                        if activity_end_time > last_activity_time_db:
+                            page_has_new = True
+                        obj_id = get_attrib_uri(activity, 'object')
+                        # if we haven't seen it yet and it's about a Curation
+                        if activity_end_time > last_activity_time_db and \
+                                activity['object']['@type'] == \
+                                'cr:Curation' and \
+                                obj_id not in seen_activity_objs:
+                            if last_activity_time_as == None or \
+                                    activity_end_time > last_activity_time_as:
+                                last_activity_time_as = activity_end_time
+                            cur_future = None
+                            if activity['type'] in ['Create', 'Update']:
+                                # dereference Curations concurrently, starting
+                                # while the rest of the page is still parsed
+                                cur_future = fetch_executor.submit(
+                                    fetch_curation, obj_id, stats
+                                    )
+                            page_activities.append((activity, cur_future))
+                            seen_activity_objs.add(obj_id)
+                        else:
+                            if activity['type'] in ['Create', 'Update',
+                                                    'Delete']:
+                                # Reduce noise
+                                log('skipping', DEBUG)
+                finally:
+                    as_ocp.close()
+                # pages are ordered chronologically, so if this page only
+                # contains activities from before the last crawl, so do all
+                # previous ones
+                next_page = None
+                if not page_has_new:
+                    log('Reached activities of previous crawl')
+                elif as_ocp.prev:
+                    # start fetching the next page while this one is processed
+                    next_page = fetch_executor.submit(
+                        fetch_page, as_ocp.prev, stats
+                        )
+                # process in the order of the Activity Stream
+                stats.increment('activities', len(page_activities))
+                failed_urls = []
+                for activity, cur_future in page_activities:
+                    if activity['type'] in ['Create', 'Update']:
+                        log(activity['type'])
+                        curation = cur_future.result()
+                        if curation is None:
+                            # retried in later crawls
+                            failed_urls.append(
+                                get_attrib_uri(activity, 'object')
+                                )
+                            continue
+                        # updates are applied as a diff, which also makes
+                        # repeated creates harmless
+                        inserted, deleted = process_curation_create(
+                            activity, db_engine, curation
+                            )
+                        new_canvases += inserted
+                        if inserted or deleted:
+                            data_changed = True
+                    elif activity['type'] == 'Delete':
+                        log('Delete')
+                        process_curation_delete(activity, db_engine)
+                        data_changed = True
+
+                page_objs = [get_attrib_uri(activity, 'object')
+                             for activity, _ in page_activities]
+                with db_engine.begin() as db_conn:
+                    # retries queued by earlier crawls are superseded by
+                    # the activities processed now
+                    forget_retries(as_url, page_objs, db_conn)
+                    for url in failed_urls:
+                        enqueue_retry(as_url, url, db_conn)
+                    if next_page is not None:
+                        save_checkpoint(as_url, as_ocp.prev,
+                                        last_activity_time_as,
+                                        data_changed, page_objs, db_conn)
+                    else:
+                        finish_crawl(as_url, last_activity_db is not None,
+                                     last_activity_time_as or
+                                     last_activity_time_db,
+                                     db_conn)
+
+                if next_page is None:
+                    break
+                as_ocp = next_page.result()
+        return True
+    except BaseException:
+        # retries and pages processed before the failure may have changed
+        # data
+        data_changed = True
+        raise
+    finally:
+        # also when the Activity Stream is inaccessible or the crawl fails
+        finish_data_changes(db_engine, data_changed)
+
+
+def finish_data_changes(db_engine, data_changed):
+    """ Make changes of a crawl visible: bump the crawl generation (if data
+        changed) and refresh the analytics aggregates. Errors are logged.
+    """
 
-    as_oc = resp.json()
-    log('Start iterating over Activity Stream pages')
-    as_ocp = get_referenced(as_oc, 'last')
-
-    new_canvases = 0
-    new_activity = False
-    # NOTE: seen_activity_objs is used to prevent processing obsolete
-    #       activities. Since we go through the Activity Stream backwards, we
-    #       only process the most recent Activity per IIIF doc.
-    #       (Not doing so might lead to for example trying to process a Create
-    #       for a document for which a Delete was processed just before.)
-    seen_activity_objs = []
-    last_activity_time_as = None
-    # for all AS pages
-    while True:
-        # for all AC items
-        log('going through AS page {}'.format(as_ocp['id']))
-        for activity in as_ocp['orderedItems']:
-            if activity['type'] in ['Create', 'Update', 'Delete']:
-                # Reduce noise
-                log('going through {} item {}'.format(activity['type'],
-                                                      activity['id']))
-            activity_end_time = dateutil.parser.parse(activity['endTime'])
-            # if we haven't seen it yet and it's about a Curation
-            if activity_end_time > last_activity_time_db and \
-                    activity['object']['@type'] == 'cr:Curation' and \
-                    activity['object'] not in seen_activity_objs:
-                if last_activity_time_as == None:
-                    # b/c we're going backwards (i.e. from new to old)
-                    last_activity_time_as = activity_end_time
-                new_activity = True
-                if activity['type'] == 'Create':
-                    log('Create')
-                    new_canvases += process_curation_create(activity, db_engine)
-                elif activity['type'] == 'Update':
-                    log('Update')
-                    log(' ≈Delete')
-                    process_curation_delete(activity, db_engine)
-                    log(' +Create')
-                    new_canvases += process_curation_create(activity, db_engine)
-                elif activity['type'] == 'Delete':
-                    log('Delete')
-                    process_curation_delete(activity, db_engine)
-                seen_activity_objs.append(activity['object'])
-            else:
-                if activity['type'] in ['Create', 'Update', 'Delete']:
-                    # Reduce noise
-                    log('skipping')
-
-        if not as_ocp.get('prev', False):
-            break
-        as_ocp = get_referenced(as_ocp, 'prev')
-
-    if last_activity_time_as == None:
-        last_activity_time_as = last_activity_time_db
-    # persist crawl log
-    if not last_activity_db:
+    if data_changed:
+        try:
+            bump_crawl_generation(db_engine)
+        except Exception:
+            log('Bumping the crawl generation failed.\n{}'.format(
+                traceback.format_exc()
+                ), ERROR)
+    # (also picks up canvases left dirty by earlier failed refreshes)
+    try:
+        refresh_analytics(db_engine)
+    except Exception:
+        log('Refreshing analytics failed.\n{}'.format(
+            traceback.format_exc()
+            ), ERROR)
+
+
+def finish_crawl(as_url, crawled_before, last_activity_time, db_conn):
+    """ Persist the time of the newest activity of a completed crawl and
+        remove its checkpoint.
+    """
+
+    if not crawled_before:
         last_activity_update = sqla_text('''
             INSERT INTO last_activity_times(acticity_stream_url, last_activity)
             VALUES (:as_url, :new_time)''')
@@ -276,96 +751,202 @@ def crawl_single(as_url, db_engine):
             SET last_activity=:new_time
             WHERE acticity_stream_url=:as_url
             ''')
-
-    last_activity_db = db_engine.execute(
+    db_conn.execute(
         last_activity_update,
-        new_time=last_activity_time_as.isoformat(),
+        new_time=last_activity_time.isoformat(),
         as_url=as_url)
+    clear_checkpoint(as_url, db_conn)
 
-    if new_activity:
-        pass
-        # foo
-    else:
-        pass
-        # bar
+
+def bump_crawl_generation(db_engine):
+    """ Mark the indexed data as changed (e.g. to invalidate query caches of
+        the endpoint).
+    """
+
+    q = sqla_text('''
+        UPDATE crawl_generation
+        SET generation=generation+1, changed_at=:now
+        WHERE id=1''')
+    db_engine.execute(q, now=datetime.datetime.utcnow().isoformat())
+
+
+def crawl_single_isolated(as_url, db_engine):
+    """ Crawl a single Activity Stream such that errors don't affect the
+        crawling of other Activity Streams.
+    """
+
+    stats = CrawlStats()
+    success = False
+    try:
+        success = crawl_single(as_url, db_engine, stats)
+    except Exception:
+        msg = 'Crawling Activity Stream {} failed.\n{}'.format(
+            as_url,
+            traceback.format_exc()
+            )
+        log(msg, ERROR)
+        print(msg)
+    try:
+        record_crawl(db_engine, as_url, stats, success)
+    except Exception:
+        log('Could not record crawl statistics of {}.\n{}'.format(
+            as_url,
+            traceback.format_exc()
+            ), ERROR)
 
 
 def db_setup(uri):
     """ Setup DB
     """
 
-    db_engine = create_engine(uri)
-
-    create_canvases_table = '''
-        CREATE TABLE IF NOT EXISTS canvases (
-          id SERIAL UNIQUE,
-          jsonld_id TEXT,
-          manifest_jsonld_id TEXT,
-          PRIMARY KEY(jsonld_id, manifest_jsonld_id)
-        );'''
-    create_curations_table = '''
-        CREATE TABLE IF NOT EXISTS curations (
-          id SERIAL UNIQUE,
-          jsonld_id TEXT PRIMARY KEY
-        );'''
-    create_curation_elements_table = '''
-        CREATE TABLE IF NOT EXISTS curation_elements (
-          id SERIAL PRIMARY KEY,
-          canvas_id INTEGER REFERENCES canvases(id),
-          curation_id INTEGER REFERENCES curations(id),
-          area GEOMETRY(Polygon)
-        );'''
-    create_last_activities_table = '''
-        CREATE TABLE IF NOT EXISTS last_activity_times (
-          acticity_stream_url TEXT PRIMARY KEY,
-          last_activity TEXT -- ISO format UTC time
-        );'''
-
-    db_engine.execute(create_canvases_table)
-    db_engine.execute(create_curations_table)
-    db_engine.execute(create_curation_elements_table)
-    db_engine.execute(create_last_activities_table)
+    db_engine = get_engine(uri)
+    migrate(db_engine)
     return db_engine
 
 
-def log(msg):
-    """ Write a log message.
+def acquire_crawl_leadership(db_engine):
+    """ Try to become the process that crawls and return whether this
+        process is it.
+
+        Among all web workers and crawler daemons using the same DB only one
+        crawls. Leadership is a session level advisory lock, held on a
+        dedicated DB connection until the process exits or the connection is
+        lost (at which point another process can take over).
     """
 
-    cfg = Cfg()
-    timestamp = str(datetime.datetime.now()).split('.')[0]
-    fn = cfg.cfg['log_file']
-    # make /dev/stdout usable as log file
-    # https://www.bugs.python.org/issue27805
-    # side note: stat.S_ISCHR(os.stat(fn).st_mode) doesn't seem to work in an
-    #            alpine linux docker container running canvas indexer with
-    #            gunicorn although manually executing it on a python shell in
-    #            the container works
-    if fn == '/dev/stdout':
-        mode = 'w'
-    else:
-        mode = 'a'
-    with open(fn, mode) as f:
-        f.write('[{}]   {}\n'.format(timestamp, msg))
+    global _leader_conn, _leader_pid
+
+    with _leader_lock:
+        if _leader_conn is not None and _leader_pid == os.getpid():
+            try:
+                _leader_conn.execute('SELECT 1')
+                return True
+            except Exception:
+                log('Lost the DB connection holding the crawl lock.', WARNING)
+                _leader_conn.invalidate()
+                _leader_conn = None
+        # autocommit, so that the connection doesn't sit idle in a
+        # transaction for the lifetime of the process
+        conn = db_engine.connect().execution_options(
+            isolation_level='AUTOCOMMIT'
+            )
+        acquired = conn.execute(
+            sqla_text('SELECT pg_try_advisory_lock(:id)'),
+            id=CRAWL_LOCK_ID
+            ).scalar()
+        if not acquired:
+            conn.close()
+            return False
+        _leader_conn = conn
+        _leader_pid = os.getpid()
+        return True
+
+
+def release_crawl_leadership():
+    """ Give up crawling (if this process is the leader).
+    """
+
+    global _leader_conn
+
+    with _leader_lock:
+        if _leader_conn is None or _leader_pid != os.getpid():
+            return
+        try:
+            _leader_conn.execute(sqla_text('SELECT pg_advisory_unlock(:id)'),
+                                 id=CRAWL_LOCK_ID)
+        finally:
+            _leader_conn.close()
+            _leader_conn = None
 
 
 def crawl():
-    """ Crawl all the Activity Streams.
+    """ Crawl all the Activity Streams, unless another process is the crawl
+        leader. Return True if a crawl was performed.
     """
 
-    cfg = Cfg()
-    activity_stream_urls = cfg.cfg['activity_stream_list']
-    db_engine = db_setup(cfg.cfg['db_uri'])
+    cfg = get_cfg()
+    activity_stream_urls = cfg.activity_stream_list
+    db_engine = db_setup(cfg.db_uri)
+
+    if not acquire_crawl_leadership(db_engine):
+        log('Not crawling, another process holds the crawl lock.')
+        return False
 
     log('- - - - - - - - - - START - - - - - - - - - -')
     log('Going through {} activity stream(s).'.format(len(activity_stream_urls)))
 
-    # crawl
-    for url in activity_stream_urls:
-        crawl_single(url, db_engine)
-
+    # crawl (concurrently if crawl_concurrency > 1)
+    max_workers = max(1, min(cfg.crawl_concurrency, len(activity_stream_urls)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for url in activity_stream_urls:
+            executor.submit(crawl_single_isolated, url, db_engine)
+
+    cache = http_cache()
+    if cache is not None:
+        log('HTTP cache: {hits} hits, {misses} misses, {evictions} evictions, '
+            '{entries} entries ({bytes} bytes)'.format(**cache.stats()))
+    maintain(db_engine)
     log('- - - - - - - - - - END - - - - - - - - - -')
+    return True
+
+
+def maintain(db_engine):
+    """ Run DB maintenance if it's due (every gc_interval hours). Only to be
+        called by the crawl leader.
+    """
+
+    global _last_maintenance
+
+    cfg = get_cfg()
+    if cfg.gc_interval <= 0 or (
+            _last_maintenance is not None and
+            time.time() - _last_maintenance < cfg.gc_interval * 3600):
+        return
+    _last_maintenance = time.time()
+    try:
+        report = run_maintenance(db_engine)
+    except Exception:
+        log('DB maintenance failed.\n{}'.format(traceback.format_exc()),
+            ERROR)
+        return
+    if report['orphaned_canvases']:
+        # unknown canvases are answered differently than canvases without
+        # Curation elements
+        bump_crawl_generation(db_engine)
+
+
+def schedule_crawls(scheduler):
+    """ Add a job to an APScheduler scheduler that crawls right away and then
+        every crawl_interval hours.
+    """
+
+    scheduler.add_job(
+        func=crawl,
+        trigger='interval',
+        hours=get_cfg().crawl_interval,
+        next_run_time=datetime.datetime.now(),
+        max_instances=1,
+        coalesce=True)
 
 
 if __name__ == '__main__':
-    crawl()
+    parser = argparse.ArgumentParser(
+        description='Crawl the Activity Streams given in config.ini.'
+        )
+    parser.add_argument('--daemon', action='store_true',
+                        help='keep running and crawl every crawl_interval '
+                             'hours (default: crawl once and exit)')
+    args = parser.parse_args()
+    install_sighup_handler()
+    if args.daemon:
+        from apscheduler.schedulers.blocking import BlockingScheduler
+        scheduler = BlockingScheduler()
+        schedule_crawls(scheduler)
+        try:
+            scheduler.start()
+        except (KeyboardInterrupt, SystemExit):
+            pass
+    else:
+        if not crawl():
+            print('Not crawling, another process holds the crawl lock.')
+        release_crawl_leadership()
@@ -0,0 +1,104 @@
+""" Process wide database engine.
+
+    Both the query endpoint and the crawler get their engine from here instead
+    of calling create_engine themselves, so that connections are pooled and
+    reused across requests and crawling runs.
+"""
+
+import os
+import threading
+import time
+from sqlalchemy import create_engine
+from sqlalchemy import exc as sqla_exc
+from sqlalchemy.pool import QueuePool
+from config import get_cfg
+
+_engines = {}
+_engines_pid = None
+_engines_lock = threading.Lock()
+
+
+class InstrumentedQueuePool(QueuePool):
+    """ QueuePool that keeps count of how often a checkout had to wait for a
+        connection to be returned and how often such a wait timed out.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats_lock = threading.Lock()
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.timeouts = 0
+
+    def _do_get(self):
+        # same condition QueuePool uses to decide whether to block
+        must_wait = self._max_overflow > -1 and \
+            self._overflow >= self._max_overflow and \
+            self._pool.empty()
+        start = time.time()
+        try:
+            return super()._do_get()
+        except sqla_exc.TimeoutError:
+            with self.stats_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            if must_wait:
+                with self.stats_lock:
+                    self.waits += 1
+                    self.wait_seconds += time.time() - start
+
+
+def _create_engine(uri):
+    cfg = get_cfg()
+    return create_engine(
+        uri,
+        poolclass=InstrumentedQueuePool,
+        pool_size=cfg.db_pool_size,
+        max_overflow=cfg.db_max_overflow,
+        pool_timeout=cfg.db_pool_timeout,
+        pool_recycle=cfg.db_pool_recycle,
+        pool_pre_ping=cfg.db_pool_pre_ping)
+
+
+def get_engine(uri=None):
+    """ Return the engine for the given DB URI (default: the configured one).
+
+        Engines are created lazily and per process. A process forked after an
+        engine was created (e.g. a gunicorn worker of a preloaded app) gets a
+        fresh engine rather than sharing the parent's pooled connections.
+    """
+
+    global _engines, _engines_pid
+
+    if uri is None:
+        uri = get_cfg().db_uri
+    pid = os.getpid()
+    with _engines_lock:
+        if _engines_pid != pid:
+            # inherited from a parent process; don't dispose, b/c that would
+            # close sockets the parent is still using
+            _engines = {}
+            _engines_pid = pid
+        if uri not in _engines:
+            _engines[uri] = _create_engine(uri)
+        return _engines[uri]
+
+
+def pool_stats(uri=None):
+    """ Return a dict describing the state of the connection pool of this
+        process' engine for the given DB URI.
+    """
+
+    pool = get_engine(uri).pool
+    with pool.stats_lock:
+        return {
+            'size': pool.size(),
+            'checked_in': pool.checkedin(),
+            'checked_out': pool.checkedout(),
+            # negative while fewer than size connections have been opened
+            'overflow': max(0, pool.overflow()),
+            'waits': pool.waits,
+            'wait_seconds': pool.wait_seconds,
+            'timeouts': pool.timeouts,
+            }
@@ -0,0 +1,260 @@
+""" On-disk HTTP response cache for the crawler.
+
+    Responses that carry an ETag or Last-Modified header are stored on disk
+    together with these validators. Later requests for the same URL are made
+    conditional (If-None-Match / If-Modified-Since), so that unchanged
+    resources are answered with 304 Not Modified and served from disk.
+
+    Bodies are written to the cache while they are read from the network, so
+    caching doesn't delay their processing.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+
+class CachedResponse():
+    """ Minimal stand-in for requests.Response for responses whose body is
+        stored in the cache.
+    """
+
+    def __init__(self, url, headers, body_path, from_cache):
+        self.url = url
+        self.status_code = 200
+        self.headers = headers
+        self.from_cache = from_cache
+        # opened right away, so the body stays readable even if the entry is
+        # evicted in the meantime
+        self._f = open(body_path, 'rb')
+        self._content = None
+
+    @property
+    def content(self):
+        if self._content is None:
+            self._content = self._f.read()
+            self._f.close()
+        return self._content
+
+    @property
+    def raw(self):
+        """ The body as a binary file object (like requests.Response.raw).
+        """
+
+        return self._f
+
+    def json(self):
+        return json.loads(self.content.decode('utf-8'))
+
+    def close(self):
+        self._f.close()
+
+
+class StoringResponse():
+    """ Minimal stand-in for requests.Response for responses that are stored
+        in the cache while their body is read (through raw, content or
+        json()). The entry is added to the cache once the body has been read
+        completely; if the response is closed before, it is discarded.
+    """
+
+    def __init__(self, cache, key, url, resp):
+        self.url = url
+        self.status_code = 200
+        self.headers = dict(resp.headers)
+        self.from_cache = False
+        self._cache = cache
+        self._key = key
+        self._resp = resp
+        # undo Content-Encoding (as resp.content would)
+        resp.raw.decode_content = True
+        fd, self._tmp_path = tempfile.mkstemp(dir=cache.directory,
+                                              suffix='.tmp')
+        self._tmp = os.fdopen(fd, 'wb')
+        self._size = 0
+        self._content = None
+
+    def read(self, size=-1):
+        if self._tmp is None:
+            return b''
+        data = self._resp.raw.read(None if size < 0 else size)
+        self._tmp.write(data)
+        self._size += len(data)
+        if size < 0 or (size > 0 and not data):
+            self._tmp.close()
+            self._tmp = None
+            self._cache._add(self._key, self.url, self.headers,
+                             self._tmp_path, self._size)
+        return data
+
+    @property
+    def content(self):
+        if self._content is None:
+            self._content = self.read()
+            self.close()
+        return self._content
+
+    @property
+    def raw(self):
+        """ The body as a binary file object (like requests.Response.raw).
+        """
+
+        return self
+
+    def json(self):
+        return json.loads(self.content.decode('utf-8'))
+
+    def close(self):
+        if self._tmp is not None:
+            # not read completely
+            self._tmp.close()
+            self._tmp = None
+            os.remove(self._tmp_path)
+        self._resp.close()
+
+
+class HTTPCache():
+    """ Size bounded HTTP cache with least recently used eviction.
+
+        Every entry consists of two files named after the SHA-256 hash of the
+        URL: <hash>.body (response body) and <hash>.meta (URL, validators and
+        headers as JSON). The modification time of the body file is used as
+        last access time, so the LRU order survives restarts.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+        # key -> size, least recently used first
+        self.entries = OrderedDict()
+        found = []
+        for fn in os.listdir(directory):
+            if not fn.endswith('.body'):
+                continue
+            key = fn[:-5]
+            try:
+                st = os.stat(self._path(key, 'body'))
+            except OSError:
+                continue
+            found.append((st.st_mtime, key, st.st_size))
+        for _, key, size in sorted(found):
+            self.entries[key] = size
+        self.size = sum(self.entries.values())
+        with self.lock:
+            self._evict()
+
+    def _path(self, key, ext):
+        return os.path.join(self.directory, '{}.{}'.format(key, ext))
+
+    def _load_meta(self, key):
+        try:
+            with open(self._path(key, 'meta')) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _evict(self, keep=None):
+        """ Remove least recently used entries (except the one with the key
+            keep) until the cache fits into max_bytes. Has to be called with
+            self.lock held.
+        """
+
+        while self.size > self.max_bytes and self.entries:
+            key = next(iter(self.entries))
+            if key == keep:
+                if len(self.entries) == 1:
+                    break
+                self.entries.move_to_end(key)
+                continue
+            for ext in ['meta', 'body']:
+                try:
+                    os.remove(self._path(key, ext))
+                except OSError:
+                    pass
+            self.size -= self.entries.pop(key)
+            self.evictions += 1
+
+    def _add(self, key, url, headers, tmp_body, size):
+        """ Add an entry whose body was written to the file tmp_body. A body
+            larger than the whole cache is not kept.
+        """
+
+        if size > self.max_bytes:
+            os.remove(tmp_body)
+            return
+        meta = {
+            'url': url,
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+            'headers': headers
+            }
+        fd, tmp_meta = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(meta, f)
+        with self.lock:
+            os.replace(tmp_body, self._path(key, 'body'))
+            os.replace(tmp_meta, self._path(key, 'meta'))
+            self.size += size - self.entries.pop(key, 0)
+            self.entries[key] = size
+            self._evict(keep=key)
+
+    def get(self, session, url):
+        """ GET a URL using the given requests session, sending validators of
+            a cached response if there is one. Returns a CachedResponse for
+            cached responses, a StoringResponse for cacheable ones and a
+            requests.Response otherwise.
+        """
+
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        meta = None
+        if key in self.entries:
+            meta = self._load_meta(key)
+        headers = {}
+        if meta:
+            if meta['etag']:
+                headers['If-None-Match'] = meta['etag']
+            if meta['last_modified']:
+                headers['If-Modified-Since'] = meta['last_modified']
+        resp = session.get(url, headers=headers, stream=True)
+        if resp.status_code == 304 and meta:
+            resp.close()
+            with self.lock:
+                if key in self.entries:
+                    now = time.time()
+                    self.entries.move_to_end(key)
+                    try:
+                        os.utime(self._path(key, 'body'), (now, now))
+                        cached = CachedResponse(
+                            url, meta['headers'], self._path(key, 'body'), True
+                            )
+                    except OSError:
+                        cached = None
+                    if cached:
+                        self.hits += 1
+                        return cached
+            # evicted in the meantime
+            resp = session.get(url, stream=True)
+        with self.lock:
+            self.misses += 1
+        if resp.status_code == 200 and \
+                (resp.headers.get('ETag') or resp.headers.get('Last-Modified')):
+            return StoringResponse(self, key, url, resp)
+        return resp
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self.entries),
+                'bytes': self.size,
+                }
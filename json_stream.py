@@ -0,0 +1,131 @@
+""" Incremental parsing of Activity Stream pages and Curations.
+
+    Documents are parsed with ijson while they are read (from the network or
+    the HTTP cache), so processing starts before a download is complete and
+    large documents are never held in memory as a whole: activities of a page
+    are yielded one at a time, and of a Curation only its elements are kept.
+"""
+
+import hashlib
+import ijson
+from ijson.common import ObjectBuilder
+
+
+def _uri(value):
+    """ URI of a value that is either a URI or an object with an id.
+    """
+
+    if isinstance(value, str):
+        return value
+    if isinstance(value, dict):
+        return value.get('id') or value.get('@id')
+    return None
+
+
+def iter_items(events, prefixes, ends=()):
+    """ Generate (prefix, value) tuples for all values in a stream of ijson
+        parse events whose prefix is in prefixes (objects and arrays are
+        built in full), and (prefix, None) at the end of every object or
+        array whose prefix is in ends.
+    """
+
+    for prefix, event, value in events:
+        if prefix in prefixes:
+            if event in ['start_map', 'start_array']:
+                builder = ObjectBuilder()
+                depth = 1
+                while depth:
+                    builder.event(event, value)
+                    prefix, event, value = next(events)
+                    if event in ['start_map', 'start_array']:
+                        depth += 1
+                    elif event in ['end_map', 'end_array']:
+                        depth -= 1
+                yield prefix, builder.value
+            elif event != 'map_key':
+                yield prefix, value
+        elif prefix in ends and event in ['end_map', 'end_array']:
+            yield prefix, None
+
+
+class HashingReader():
+    """ File wrapper computing the SHA-256 hash of everything read.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.sha256.update(data)
+        return data
+
+    def hexdigest(self):
+        # include anything not consumed by the parser (e.g. trailing
+        # whitespace)
+        self.read()
+        return self.sha256.hexdigest()
+
+
+class PageStream():
+    """ An Activity Stream page. Its activities are parsed one at a time
+        while they are iterated over; the page's id and prev link are known
+        once they have been passed.
+    """
+
+    def __init__(self, url, f):
+        self.url = url
+        self.f = f
+        self.id = None
+        self.prev = None
+
+    def activities(self):
+        events = ijson.parse(self.f)
+        for prefix, value in iter_items(events,
+                                        ['id', 'prev', 'orderedItems.item']):
+            if prefix == 'orderedItems.item':
+                yield value
+            elif prefix == 'id':
+                self.id = value
+            elif prefix == 'prev':
+                self.prev = _uri(value)
+
+    def close(self):
+        self.f.close()
+
+
+def parse_curation(f):
+    """ Parse a Curation and return a tuple (Curation URI, SHA-256 hash of
+        the document, elements). Elements ("cutouts") are tuples (canvas URI,
+        manifest URI, x, y, w, h).
+    """
+
+    reader = HashingReader(f)
+    events = ijson.parse(reader)
+    cur_id = None
+    elements = []
+    # the manifest of a range may be given after its members
+    manifest_id = None
+    range_canvases = []
+    for prefix, value in iter_items(
+            events,
+            ['@id', 'selections.item.within', 'selections.item.members.item',
+             'selections.item.canvases.item'],
+            ends=['selections.item']):
+        if prefix == '@id':
+            cur_id = value
+        elif prefix == 'selections.item.within':
+            manifest_id = _uri(value)
+        elif prefix == 'selections.item':
+            # end of a range
+            for can_id, region in range_canvases:
+                x, y, w, h = [int(elem) for elem
+                              in region.replace('xywh=', '').split(',')]
+                elements.append((can_id, manifest_id, x, y, w, h))
+            manifest_id = None
+            range_canvases = []
+        else:
+            can_id, region = value['@id'].split('#')
+            range_canvases.append((can_id, region))
+    return cur_id, reader.hexdigest(), elements
@@ -0,0 +1,152 @@
+""" Buffered logging for the crawler.
+
+    Log messages are put in a queue and written by a background thread in
+    batches, so logging doesn't cost a file open/write/close on the calling
+    thread for every message.
+"""
+
+import atexit
+import datetime
+import json
+import os
+import queue
+import threading
+import time
+from config import get_cfg
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVELS = {
+    'debug': DEBUG,
+    'info': INFO,
+    'warning': WARNING,
+    'error': ERROR,
+    }
+LEVEL_NAMES = {val: key for key, val in LEVELS.items()}
+
+_logger = None
+_logger_lock = threading.Lock()
+
+
+class QueueLogger():
+    """ Logger that hands messages to a writer thread.
+
+        The writer collects messages for up to flush_interval seconds (or
+        until batch_size messages are pending), writes them and flushes the
+        file once per batch.
+    """
+
+    def __init__(self, path, fmt='text', flush_interval=0.5, batch_size=1024):
+        self.path = path
+        self.fmt = fmt
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.pid = os.getpid()
+        self.queue = queue.Queue()
+        self._stop = object()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def log(self, msg, level=INFO):
+        self.queue.put((time.time(), level, msg))
+
+    def close(self):
+        """ Write all pending messages and stop the writer thread.
+        """
+
+        if self.thread.is_alive():
+            self.queue.put(self._stop)
+            self.thread.join()
+
+    def _format(self, entry):
+        timestamp, level, msg = entry
+        dt = datetime.datetime.fromtimestamp(timestamp)
+        if self.fmt == 'json':
+            return json.dumps({
+                'time': dt.isoformat(),
+                'level': LEVEL_NAMES.get(level, str(level)),
+                'msg': msg
+                }) + '\n'
+        return '[{}]   {}\n'.format(str(dt).split('.')[0], msg)
+
+    def _run(self):
+        # make /dev/stdout usable as log file
+        # https://www.bugs.python.org/issue27805
+        # side note: stat.S_ISCHR(os.stat(fn).st_mode) doesn't seem to work in
+        #            an alpine linux docker container running canvas indexer
+        #            with gunicorn although manually executing it on a python
+        #            shell in the container works
+        if self.path == '/dev/stdout':
+            mode = 'w'
+        else:
+            mode = 'a'
+        with open(self.path, mode) as f:
+            stop = False
+            while not stop:
+                batch = [self.queue.get()]
+                deadline = time.time() + self.flush_interval
+                while len(batch) < self.batch_size:
+                    timeout = deadline - time.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(self.queue.get(timeout=timeout))
+                    except queue.Empty:
+                        break
+                    if batch[-1] is self._stop:
+                        break
+                lines = []
+                for entry in batch:
+                    if entry is self._stop:
+                        stop = True
+                        break
+                    lines.append(self._format(entry))
+                f.write(''.join(lines))
+                f.flush()
+
+
+def get_logger():
+    """ Return the process wide logger for the configured log file.
+    """
+
+    global _logger
+
+    cfg = get_cfg()
+    logger = _logger
+    if logger is not None and logger.pid == os.getpid() and \
+            logger.path == cfg.log_file and logger.fmt == cfg.log_format:
+        return logger
+    with _logger_lock:
+        if _logger is None or _logger.pid != os.getpid() or \
+                _logger.path != cfg.log_file or _logger.fmt != cfg.log_format:
+            if _logger is not None and _logger.pid == os.getpid():
+                # log file or format changed
+                _logger.close()
+            _logger = QueueLogger(cfg.log_file, cfg.log_format)
+        return _logger
+
+
+def log(msg, level=INFO):
+    """ Write a log message (if its level is not below the configured one).
+    """
+
+    if level < LEVELS[get_cfg().log_level]:
+        return
+    get_logger().log(msg, level)
+
+
+def flush():
+    """ Write all pending log messages.
+    """
+
+    global _logger
+
+    with _logger_lock:
+        if _logger is not None and _logger.pid == os.getpid():
+            _logger.close()
+        _logger = None
+
+
+atexit.register(flush)
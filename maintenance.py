@@ -0,0 +1,119 @@
+""" Maintenance of the DB: removal of orphaned rows and compaction.
+
+    Deleted and updated Curations leave canvases without any Curation
+    elements behind. These are removed in bounded batches, within a time
+    budget, after crawls (see crawler.crawl), and tables with dead rows are
+    optionally vacuumed afterwards (if the time budget isn't used up).
+
+    Usage:
+        python3 maintenance.py  run maintenance once (unless another
+                                process is crawling)
+"""
+
+import time
+from sqlalchemy import text as sqla_text
+from config import get_cfg
+from logger import log
+
+MAINTAINED_TABLES = ['canvases', 'curation_elements', 'curations']
+
+
+def delete_orphaned_canvases(db_engine, batch_size, time_budget):
+    """ Delete canvases without Curation elements, batch_size at a time,
+        until there are none left or time_budget seconds have passed. Return
+        the number of deleted canvases.
+
+        Must not run concurrently with a crawl (a canvas could become
+        orphaned and referenced again in between), which is ensured by
+        running it in the crawl leader.
+    """
+
+    q = sqla_text('''
+        DELETE FROM canvases
+        WHERE id IN (
+            SELECT id
+            FROM canvases
+            WHERE NOT EXISTS (
+                SELECT 1
+                FROM curation_elements
+                WHERE curation_elements.canvas_id = canvases.id)
+            LIMIT :batch_size)''')
+    start = time.time()
+    deleted = 0
+    while time.time() - start < time_budget:
+        with db_engine.begin() as db_conn:
+            batch_deleted = db_conn.execute(q, batch_size=batch_size).rowcount
+        deleted += batch_deleted
+        if batch_deleted < batch_size:
+            break
+    return deleted
+
+
+def dead_rows(db_engine):
+    """ Return a dict mapping maintained tables to their number of dead rows
+        (as estimated by the statistics collector). Dead rows are left by
+        deletions and updates and removed by VACUUM, which makes their space
+        reusable (without shrinking the files on disk).
+
+        The statistics are updated asynchronously and may lag behind, so
+        they only serve to pick the tables worth vacuuming.
+    """
+
+    q = sqla_text('''
+        SELECT relname, n_dead_tup
+        FROM pg_stat_user_tables
+        WHERE relname = ANY(CAST(:tables AS TEXT[]))''')
+    return dict(db_engine.execute(q, tables=MAINTAINED_TABLES).fetchall())
+
+
+def vacuum(db_engine, tables):
+    """ VACUUM ANALYZE the given tables. Doesn't block reads or writes.
+    """
+
+    # VACUUM can't run inside a transaction
+    with db_engine.connect() as conn:
+        conn = conn.execution_options(isolation_level='AUTOCOMMIT')
+        for table in tables:
+            conn.execute('VACUUM ANALYZE {}'.format(table))
+
+
+def run_maintenance(db_engine):
+    """ Delete orphaned rows and, if configured and there is time left in
+        the budget, vacuum tables with dead rows. Return a dict reporting
+        what was done.
+    """
+
+    cfg = get_cfg()
+    start = time.time()
+    report = {
+        'orphaned_canvases': delete_orphaned_canvases(
+            db_engine,
+            cfg.gc_batch_size,
+            cfg.gc_time_budget
+            ),
+        'vacuumed': [],
+        }
+    if cfg.gc_vacuum and time.time() - start < cfg.gc_time_budget:
+        report['vacuumed'] = sorted(table for table, n
+                                    in dead_rows(db_engine).items() if n > 0)
+        vacuum(db_engine, report['vacuumed'])
+    report['seconds'] = time.time() - start
+    log('Maintenance: deleted {orphaned_canvases} orphaned canvases, '
+        'vacuumed [{vacuumed_str}] ({seconds:.1f}s)'.format(
+            vacuumed_str=', '.join(report['vacuumed']),
+            **report))
+    return report
+
+
+if __name__ == '__main__':
+    from crawler import acquire_crawl_leadership, bump_crawl_generation
+    from crawler import db_setup, release_crawl_leadership
+    db_engine = db_setup(get_cfg().db_uri)
+    if not acquire_crawl_leadership(db_engine):
+        print('Not running, another process holds the crawl lock.')
+    else:
+        report = run_maintenance(db_engine)
+        if report['orphaned_canvases']:
+            bump_crawl_generation(db_engine)
+        print(report)
+        release_crawl_leadership()
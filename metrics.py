@@ -0,0 +1,404 @@
+""" Metrics in the Prometheus text format.
+
+    Crawl statistics are stored per Activity Stream in the DB (table
+    crawl_stats), since crawls may run in another process than the web
+    application (see crawler.acquire_crawl_leadership).
+
+    Query timings and DB pool and query cache statistics are kept per
+    process. Every process writes a snapshot of them to a JSON file named
+    after its PID and start time (PIDs are reused) in metrics_dir every
+    SNAPSHOT_INTERVAL seconds, from a background thread started when the
+    application registers its collectors (and again in forked children), so
+    also while it is idle and before it answers a query. /metrics merges the
+    snapshots of all processes: counters and histograms of all of them
+    (including exited ones, so that counters never decrease), gauges of the
+    processes still running whose snapshot is recent (at most
+    STALE_SNAPSHOT_AGE seconds old). metrics_dir should be emptied when the
+    application is (re)started.
+"""
+
+import atexit
+import datetime
+import json
+import os
+import threading
+import time
+import dateutil.parser
+from sqlalchemy import text as sqla_text
+from config import get_cfg
+
+# upper bounds of histogram buckets in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+           5.0, 10.0)
+QUERY_PHASES = ['db', 'build', 'serialize']
+SNAPSHOT_INTERVAL = 1  # seconds
+STALE_SNAPSHOT_AGE = 5 * SNAPSHOT_INTERVAL
+
+# (snapshot key, stat, metric name, type, help)
+COLLECTED_METRICS = [
+    ('db_pool', 'size', 'tracer_db_pool_size', 'gauge',
+     'Configured number of DB connections kept open'),
+    ('db_pool', 'checked_out', 'tracer_db_pool_checked_out', 'gauge',
+     'DB connections in use'),
+    ('db_pool', 'checked_in', 'tracer_db_pool_checked_in', 'gauge',
+     'Idle DB connections'),
+    ('db_pool', 'overflow', 'tracer_db_pool_overflow', 'gauge',
+     'DB connections opened in addition to the pool size'),
+    ('db_pool', 'waits', 'tracer_db_pool_waits_total', 'counter',
+     'Times a DB connection had to be waited for'),
+    ('db_pool', 'wait_seconds', 'tracer_db_pool_wait_seconds_total',
+     'counter', 'Time spent waiting for DB connections'),
+    ('db_pool', 'timeouts', 'tracer_db_pool_timeouts_total', 'counter',
+     'Times no DB connection became available in time'),
+    ('query_cache', 'hits', 'tracer_query_cache_hits_total', 'counter',
+     'Trace queries answered from the query cache'),
+    ('query_cache', 'misses', 'tracer_query_cache_misses_total', 'counter',
+     'Trace queries not found in the query cache'),
+    ('query_cache', 'evictions', 'tracer_query_cache_evictions_total',
+     'counter', 'Responses evicted from the query cache'),
+    ]
+
+
+class Histogram():
+    """ Histogram of durations with the buckets given in BUCKETS.
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)  # last one: > BUCKETS[-1]
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                break
+        else:
+            i = len(BUCKETS)
+        self.counts[i] += 1
+        self.sum += value
+
+    def to_dict(self):
+        return {'counts': list(self.counts), 'sum': self.sum}
+
+
+class CrawlStats():
+    """ Counts of a single crawl of an Activity Stream. Shared by the threads
+        fetching documents for the crawl.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.pages = 0
+        self.activities = 0
+        self.dereference_failures = 0
+
+    def increment(self, name, n=1):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + n)
+
+
+def record_crawl(db_engine, as_url, stats, success):
+    """ Add the counts of a crawl to the stored statistics of an Activity
+        Stream.
+    """
+
+    now = datetime.datetime.utcnow().isoformat()
+    q = sqla_text('''
+        INSERT INTO crawl_stats(activity_stream_url, crawls, failed_crawls,
+                                pages, activities, dereference_failures,
+                                last_duration, last_crawl, last_success)
+        VALUES (:as_url, 1, :failed, :pages, :activities, :failures,
+                :duration, :now, :success_time)
+        ON CONFLICT (activity_stream_url)
+        DO UPDATE SET
+            crawls = crawl_stats.crawls + 1,
+            failed_crawls = crawl_stats.failed_crawls + EXCLUDED.failed_crawls,
+            pages = crawl_stats.pages + EXCLUDED.pages,
+            activities = crawl_stats.activities + EXCLUDED.activities,
+            dereference_failures = crawl_stats.dereference_failures +
+                EXCLUDED.dereference_failures,
+            last_duration = EXCLUDED.last_duration,
+            last_crawl = EXCLUDED.last_crawl,
+            last_success = COALESCE(EXCLUDED.last_success,
+                                    crawl_stats.last_success)''')
+    db_engine.execute(
+        q,
+        as_url=as_url,
+        failed=0 if success else 1,
+        pages=stats.pages,
+        activities=stats.activities,
+        failures=stats.dereference_failures,
+        duration=time.time() - stats.start,
+        now=now,
+        success_time=now if success else None)
+
+
+class ProcessMetrics():
+    """ Metrics of this process.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.start = time.time()
+        self.filename = '{}-{}.json'.format(self.pid, int(self.start * 1000))
+        self.queries = {phase: Histogram() for phase in QUERY_PHASES}
+        self.write_lock = threading.Lock()
+        writer = threading.Thread(target=self._write_snapshots, daemon=True)
+        writer.start()
+
+    def observe_query(self, db_seconds, build_seconds, serialize_seconds):
+        with self.lock:
+            self.queries['db'].observe(db_seconds)
+            self.queries['build'].observe(build_seconds)
+            self.queries['serialize'].observe(serialize_seconds)
+
+    def snapshot(self):
+        with self.lock:
+            snapshot = {
+                'pid': self.pid,
+                'start': self.start,
+                'written_at': time.time(),
+                'queries': {phase: hist.to_dict()
+                            for phase, hist in self.queries.items()},
+                }
+        for key, collect in list(_collectors.items()):
+            snapshot[key] = collect()
+        return snapshot
+
+    def write_snapshot(self, snapshot=None):
+        metrics_dir = get_cfg().metrics_dir
+        if not metrics_dir:
+            return
+        if snapshot is None:
+            snapshot = self.snapshot()
+        with self.write_lock:
+            os.makedirs(metrics_dir, exist_ok=True)
+            path = os.path.join(metrics_dir, self.filename)
+            tmp_path = '{}.tmp'.format(path)
+            with open(tmp_path, 'w') as f:
+                json.dump(snapshot, f)
+            os.replace(tmp_path, path)
+
+    def _write_snapshots(self):
+        while True:
+            time.sleep(SNAPSHOT_INTERVAL)
+            try:
+                self.write_snapshot()
+            except Exception:
+                # e.g. a full disk or a failing collector; the snapshot
+                # becomes stale, but the thread keeps trying
+                pass
+
+
+_process_metrics = None
+_process_metrics_lock = threading.Lock()
+_collectors = {}  # snapshot key -> function returning a dict of stats
+
+
+def register_collector(key, collect):
+    """ Include the stats returned by collect() in the snapshots of all
+        processes under the given key (see COLLECTED_METRICS). Starts
+        writing snapshots of this process.
+    """
+
+    _collectors[key] = collect
+    process_metrics()
+
+
+def process_metrics():
+    """ Return the metrics of this process.
+    """
+
+    global _process_metrics
+
+    with _process_metrics_lock:
+        if _process_metrics is None or _process_metrics.pid != os.getpid():
+            _process_metrics = ProcessMetrics()
+        return _process_metrics
+
+
+def _restart_after_fork():
+    """ Start writing snapshots of a forked child (which inherits neither the
+        writer thread nor the parent's PID), unless the parent didn't.
+    """
+
+    global _process_metrics, _process_metrics_lock
+
+    # the lock may have been held by another thread of the parent
+    _process_metrics_lock = threading.Lock()
+    if _process_metrics is not None:
+        _process_metrics = None
+        process_metrics()
+
+
+def _write_at_exit():
+    if _process_metrics is not None and _process_metrics.pid == os.getpid():
+        _process_metrics.write_snapshot()
+
+
+os.register_at_fork(after_in_child=_restart_after_fork)
+atexit.register(_write_at_exit)
+
+
+def _pid_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _snapshots():
+    """ Return a list of (snapshot, current) tuples of all processes, current
+        telling whether the process is running and its snapshot recent.
+    """
+
+    own = process_metrics()
+    own_snapshot = own.snapshot()
+    own.write_snapshot(own_snapshot)
+    snapshots = [(own_snapshot, True)]
+    metrics_dir = get_cfg().metrics_dir
+    if not metrics_dir or not os.path.isdir(metrics_dir):
+        return snapshots
+    for fn in os.listdir(metrics_dir):
+        if not fn.endswith('.json') or fn == own.filename:
+            continue
+        try:
+            with open(os.path.join(metrics_dir, fn)) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            continue
+        current = _pid_running(snapshot['pid']) and \
+            time.time() - snapshot.get('written_at', 0) <= STALE_SNAPSHOT_AGE
+        snapshots.append((snapshot, current))
+    return snapshots
+
+
+def _label_value(val):
+    return val.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _metric(lines, name, metric_type, help_text, samples):
+    """ Append a metric with samples as (labels, value) tuples (labels being
+        a string like 'key="value"' or '') to lines.
+    """
+
+    lines.append('# HELP {} {}'.format(name, help_text))
+    lines.append('# TYPE {} {}'.format(name, metric_type))
+    for labels, value in samples:
+        if labels:
+            lines.append('{}{{{}}} {}'.format(name, labels, value))
+        else:
+            lines.append('{} {}'.format(name, value))
+
+
+def _timestamp(iso_time):
+    if iso_time is None:
+        return 0
+    return dateutil.parser.parse(iso_time).replace(
+        tzinfo=datetime.timezone.utc
+        ).timestamp()
+
+
+def crawl_metric_lines(db_engine):
+    q = sqla_text('''
+        SELECT activity_stream_url, crawls, failed_crawls, pages, activities,
+            dereference_failures, last_duration, last_success
+        FROM crawl_stats
+        ORDER BY activity_stream_url''')
+    rows = db_engine.execute(q).fetchall()
+    lines = []
+    for column, name, metric_type, help_text in [
+            ('crawls', 'tracer_crawls_total', 'counter',
+             'Crawls of the Activity Stream'),
+            ('failed_crawls', 'tracer_crawl_failures_total', 'counter',
+             'Crawls of the Activity Stream that failed'),
+            ('pages', 'tracer_crawl_pages_total', 'counter',
+             'Activity Stream pages fetched'),
+            ('activities', 'tracer_crawl_activities_total', 'counter',
+             'Activities processed'),
+            ('dereference_failures',
+             'tracer_crawl_dereference_failures_total', 'counter',
+             'Documents that could not be retrieved'),
+            ('last_duration', 'tracer_crawl_duration_seconds', 'gauge',
+             'Duration of the last crawl of the Activity Stream')]:
+        _metric(lines, name, metric_type, help_text, [
+            ('stream="{}"'.format(_label_value(row['activity_stream_url'])),
+             row[column])
+            for row in rows])
+    q_retries = sqla_text('''
+        SELECT activity_stream_url,
+            count(*) FILTER (WHERE next_attempt IS NOT NULL) AS pending,
+            count(*) FILTER (WHERE next_attempt IS NULL) AS abandoned
+        FROM dereference_retries
+        GROUP BY activity_stream_url
+        ORDER BY activity_stream_url''')
+    retry_rows = db_engine.execute(q_retries).fetchall()
+    for column, name, help_text in [
+            ('pending', 'tracer_crawl_pending_retries',
+             'Curations waiting to be retrieved again'),
+            ('abandoned', 'tracer_crawl_abandoned_retries',
+             'Curations not retried anymore after too many failures')]:
+        _metric(lines, name, 'gauge', help_text, [
+            ('stream="{}"'.format(_label_value(row['activity_stream_url'])),
+             row[column])
+            for row in retry_rows])
+    _metric(lines, 'tracer_crawl_last_success_timestamp_seconds', 'gauge',
+            'Time of the last successful crawl of the Activity Stream', [
+                ('stream="{}"'.format(
+                    _label_value(row['activity_stream_url'])
+                    ), _timestamp(row['last_success']))
+                for row in rows])
+    return lines
+
+
+def process_metric_lines():
+    snapshots = _snapshots()
+    lines = []
+    samples = []
+    for phase in QUERY_PHASES:
+        counts = [0] * (len(BUCKETS) + 1)
+        total = 0.0
+        for snapshot, _ in snapshots:
+            hist = snapshot['queries'][phase]
+            counts = [a + b for a, b in zip(counts, hist['counts'])]
+            total += hist['sum']
+        cumulative = 0
+        for bound, count in zip(BUCKETS, counts):
+            cumulative += count
+            samples.append(('_bucket', 'phase="{}",le="{}"'.format(
+                phase, bound
+                ), cumulative))
+        samples.append(('_bucket', 'phase="{}",le="+Inf"'.format(phase),
+                        sum(counts)))
+        samples.append(('_sum', 'phase="{}"'.format(phase), total))
+        samples.append(('_count', 'phase="{}"'.format(phase), sum(counts)))
+    lines.append('# HELP tracer_query_seconds Time spent on trace queries '
+                 'by phase (DB query, response building, serialization)')
+    lines.append('# TYPE tracer_query_seconds histogram')
+    for suffix, labels, value in samples:
+        lines.append('tracer_query_seconds{}{{{}}} {}'.format(suffix, labels,
+                                                             value))
+    for key, stat, name, metric_type, help_text in COLLECTED_METRICS:
+        value = 0
+        present = False
+        for snapshot, current in snapshots:
+            if key not in snapshot or (metric_type == 'gauge' and
+                                       not current):
+                continue
+            present = True
+            value += snapshot[key][stat]
+        if present:
+            _metric(lines, name, metric_type, help_text, [('', value)])
+    return lines
+
+
+def render(db_engine):
+    """ Return all metrics in the Prometheus text format.
+    """
+
+    lines = crawl_metric_lines(db_engine) + process_metric_lines()
+    return '\n'.join(lines) + '\n'
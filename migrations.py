@@ -0,0 +1,343 @@
+""" Versioned DB schema migrations.
+
+    Migrations are applied in order at startup (see crawler.db_setup) and
+    recorded in the table schema_migrations. Every migration is written such
+    that running it again is harmless, and an advisory lock makes sure only
+    one process migrates at a time.
+
+    Usage:
+        python3 migrations.py            apply pending migrations
+        python3 migrations.py --explain  check that the trace query uses the
+                                         indexes of curation_elements
+"""
+
+import datetime
+import json
+import sys
+import time
+from sqlalchemy import exc as sqla_exc
+from sqlalchemy import text as sqla_text
+from config import get_cfg
+from analytics import mark_all_canvases_dirty
+from db import get_engine
+from queries import backlinks_query
+
+# arbitrary but fixed key for pg_advisory_lock
+MIGRATION_LOCK_ID = 74220001
+# transactional migrations don't wait for locks held by long running
+# transactions (e.g. a crawl), which would block all other queries on the
+# table in the meantime, but are retried a few times instead
+LOCK_TIMEOUT = '10s'
+LOCK_RETRIES = 5
+LOCK_RETRY_DELAY = 5  # seconds
+# SQLSTATE of a lock timeout (lock_not_available)
+LOCK_NOT_AVAILABLE = '55P03'
+MIGRATION_LOCK_POLL_INTERVAL = 1  # seconds
+TRACE_QUERY_INDEXES = ['curation_elements_area_idx',
+                       'curation_elements_canvas_id_idx']
+
+
+def create_index_concurrently(name, definition):
+    """ Return a migration step that creates an index without blocking
+        writes to the table. An invalid index left behind by an earlier
+        interrupted attempt is dropped and created anew.
+    """
+
+    def step(conn):
+        q_invalid = sqla_text('''
+            SELECT 1
+            FROM pg_class
+            JOIN pg_index ON pg_index.indexrelid = pg_class.oid
+            WHERE pg_class.relname=:name AND NOT pg_index.indisvalid''')
+        if conn.execute(q_invalid, name=name).fetchone():
+            conn.execute('DROP INDEX CONCURRENTLY IF EXISTS {}'.format(name))
+        conn.execute('CREATE INDEX CONCURRENTLY IF NOT EXISTS {} ON {}'.format(
+            name,
+            definition
+            ))
+    return step
+
+
+def init_crawl_generation(conn):
+    q = sqla_text('''
+        INSERT INTO crawl_generation(id, generation, changed_at)
+        VALUES (1, 0, :now)
+        ON CONFLICT (id)
+        DO NOTHING''')
+    conn.execute(q, now=datetime.datetime.utcnow().isoformat())
+
+
+# (version, description, run in a transaction, steps)
+# steps are SQL strings or functions taking a connection
+MIGRATIONS = [
+    (1, 'initial tables', True, [
+        '''CREATE TABLE IF NOT EXISTS canvases (
+          id SERIAL UNIQUE,
+          jsonld_id TEXT,
+          manifest_jsonld_id TEXT,
+          PRIMARY KEY(jsonld_id, manifest_jsonld_id)
+        );''',
+        '''CREATE TABLE IF NOT EXISTS curations (
+          id SERIAL UNIQUE,
+          jsonld_id TEXT PRIMARY KEY
+        );''',
+        '''CREATE TABLE IF NOT EXISTS curation_elements (
+          id SERIAL PRIMARY KEY,
+          canvas_id INTEGER REFERENCES canvases(id),
+          curation_id INTEGER REFERENCES curations(id),
+          area GEOMETRY(Polygon)
+        );''',
+        '''CREATE TABLE IF NOT EXISTS last_activity_times (
+          acticity_stream_url TEXT PRIMARY KEY,
+          last_activity TEXT -- ISO format UTC time
+        );''',
+        # single row, incremented by every crawl that changes data
+        '''CREATE TABLE IF NOT EXISTS crawl_generation (
+          id INTEGER PRIMARY KEY CHECK (id = 1),
+          generation BIGINT NOT NULL,
+          changed_at TEXT -- ISO format UTC time
+        );''',
+        init_crawl_generation,
+        ]),
+    (2, 'indexes for trace queries and deletions', False, [
+        create_index_concurrently(
+            'curation_elements_area_idx',
+            'curation_elements USING GIST (area)'
+            ),
+        create_index_concurrently(
+            'curation_elements_canvas_id_idx',
+            'curation_elements (canvas_id)'
+            ),
+        create_index_concurrently(
+            'curation_elements_curation_id_idx',
+            'curation_elements (curation_id)'
+            ),
+        'ANALYZE curation_elements',
+        ]),
+    (3, 'content hashes of curations', True, [
+        # NULL for Curations indexed before, which are therefore compared
+        # element by element on their next update
+        '''ALTER TABLE curations
+          ADD COLUMN IF NOT EXISTS content_hash TEXT;''',
+        ]),
+    (4, 'crawl statistics', True, [
+        # cumulative per Activity Stream (see metrics.record_crawl)
+        '''CREATE TABLE IF NOT EXISTS crawl_stats (
+          activity_stream_url TEXT PRIMARY KEY,
+          crawls BIGINT NOT NULL,
+          failed_crawls BIGINT NOT NULL,
+          pages BIGINT NOT NULL,
+          activities BIGINT NOT NULL,
+          dereference_failures BIGINT NOT NULL,
+          last_duration DOUBLE PRECISION, -- seconds
+          last_crawl TEXT, -- ISO format UTC time
+          last_success TEXT -- ISO format UTC time
+        );''',
+        ]),
+    (5, 'usage analytics aggregates', True, [
+        # see analytics.py
+        '''CREATE TABLE IF NOT EXISTS analytics_dirty_canvases (
+          canvas_id INTEGER PRIMARY KEY
+        );''',
+        '''CREATE TABLE IF NOT EXISTS canvas_stats (
+          canvas_id INTEGER PRIMARY KEY,
+          jsonld_id TEXT NOT NULL,
+          manifest_jsonld_id TEXT NOT NULL,
+          curations INTEGER NOT NULL,
+          elements INTEGER NOT NULL
+        );''',
+        '''CREATE INDEX IF NOT EXISTS canvas_stats_curations_idx
+          ON canvas_stats (curations DESC, elements DESC, canvas_id);''',
+        '''CREATE INDEX IF NOT EXISTS canvas_stats_manifest_idx
+          ON canvas_stats (manifest_jsonld_id, curations DESC);''',
+        '''CREATE TABLE IF NOT EXISTS manifest_stats (
+          manifest_jsonld_id TEXT PRIMARY KEY,
+          canvases INTEGER NOT NULL,
+          curations INTEGER NOT NULL,
+          elements INTEGER NOT NULL
+        );''',
+        '''CREATE INDEX IF NOT EXISTS manifest_stats_curations_idx
+          ON manifest_stats (curations DESC, elements DESC,
+                             manifest_jsonld_id);''',
+        '''CREATE TABLE IF NOT EXISTS canvas_heatmaps (
+          canvas_id INTEGER NOT NULL,
+          cell_size INTEGER NOT NULL,
+          cell_x INTEGER NOT NULL,
+          cell_y INTEGER NOT NULL,
+          count INTEGER NOT NULL,
+          PRIMARY KEY(canvas_id, cell_x, cell_y)
+        );''',
+        # aggregates of existing data are computed by the next refresh
+        mark_all_canvases_dirty,
+        ]),
+    (6, 'crawl checkpoints and dereference retries', True, [
+        # see crawl_state.py
+        '''CREATE TABLE IF NOT EXISTS crawl_checkpoints (
+          activity_stream_url TEXT PRIMARY KEY,
+          next_page TEXT NOT NULL,
+          last_activity TEXT, -- ISO format time
+          data_changed BOOLEAN NOT NULL,
+          saved_at TEXT -- ISO format UTC time
+        );''',
+        '''CREATE TABLE IF NOT EXISTS crawl_checkpoint_objects (
+          activity_stream_url TEXT,
+          object_id TEXT,
+          PRIMARY KEY(activity_stream_url, object_id)
+        );''',
+        '''CREATE TABLE IF NOT EXISTS dereference_retries (
+          activity_stream_url TEXT,
+          url TEXT,
+          attempts INTEGER NOT NULL,
+          first_failure TEXT, -- ISO format UTC time
+          last_failure TEXT, -- ISO format UTC time
+          next_attempt TEXT, -- ISO format UTC time, NULL when given up
+          PRIMARY KEY(activity_stream_url, url)
+        );''',
+        ]),
+    ]
+
+
+def _is_lock_timeout(e):
+    return getattr(e.orig, 'pgcode', None) == LOCK_NOT_AVAILABLE
+
+
+def apply_migration(conn, version, description, transactional, steps):
+    """ Apply a single migration on a connection in autocommit mode.
+    """
+
+    # the connection is in autocommit mode (required for CREATE INDEX
+    # CONCURRENTLY), so transactions are explicit
+    if transactional:
+        conn.execute('BEGIN')
+        conn.execute("SET LOCAL lock_timeout = '{}'".format(LOCK_TIMEOUT))
+    try:
+        for step in steps:
+            if callable(step):
+                step(conn)
+            else:
+                conn.execute(step)
+        q_done = sqla_text('''
+            INSERT INTO schema_migrations(version, description, applied_at)
+            VALUES (:v, :d, :t)''')
+        conn.execute(q_done, v=version, d=description,
+                     t=datetime.datetime.utcnow().isoformat())
+    except Exception:
+        if transactional:
+            conn.execute('ROLLBACK')
+        raise
+    if transactional:
+        conn.execute('COMMIT')
+
+
+def migrate(db_engine):
+    """ Apply all migrations that haven't been applied yet.
+    """
+
+    conn = db_engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+    try:
+        # other processes wait (without a timeout) while one migrates, which
+        # may take long when indexes are built on large tables. They poll
+        # rather than block in pg_advisory_lock, because CREATE INDEX
+        # CONCURRENTLY waits for the snapshots of all running statements,
+        # including a blocked pg_advisory_lock (which would deadlock).
+        q_lock = sqla_text('SELECT pg_try_advisory_lock(:id)')
+        waiting = False
+        while not conn.execute(q_lock, id=MIGRATION_LOCK_ID).scalar():
+            if not waiting:
+                print('Waiting for another process to apply DB migrations.')
+                waiting = True
+            time.sleep(MIGRATION_LOCK_POLL_INTERVAL)
+        try:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                  version INTEGER PRIMARY KEY,
+                  description TEXT,
+                  applied_at TEXT -- ISO format UTC time
+                );''')
+            applied = set(row[0] for row in conn.execute(
+                'SELECT version FROM schema_migrations'
+                ))
+            for version, description, transactional, steps in MIGRATIONS:
+                if version in applied:
+                    continue
+                print('Applying DB migration {} ({})'.format(
+                    version,
+                    description
+                    ))
+                # CREATE INDEX CONCURRENTLY (in migrations not run in a
+                # transaction) doesn't block other queries, so it waits for
+                # running transactions without a lock timeout
+                for attempt in range(1, LOCK_RETRIES + 1):
+                    try:
+                        apply_migration(conn, version, description,
+                                        transactional, steps)
+                        break
+                    except sqla_exc.OperationalError as e:
+                        if not _is_lock_timeout(e) or attempt == LOCK_RETRIES:
+                            raise
+                        print('DB migration {} timed out waiting for a lock, '
+                              'retrying.'.format(version))
+                        time.sleep(LOCK_RETRY_DELAY)
+        finally:
+            conn.execute(sqla_text('SELECT pg_advisory_unlock(:id)'),
+                         id=MIGRATION_LOCK_ID)
+    finally:
+        conn.close()
+
+
+def _plan_index_names(plan):
+    """ Return the names of all indexes used in a (JSON) query plan node and
+        its children.
+    """
+
+    names = set()
+    if 'Index Name' in plan:
+        names.add(plan['Index Name'])
+    for child in plan.get('Plans', []):
+        names |= _plan_index_names(child)
+    return names
+
+
+def check_trace_query_plan(db_engine, xywh='0,0,1000,1000',
+                           disable_seqscan=False):
+    """ EXPLAIN the trace query (with an area) for a canvas that has Curation
+        elements and return a tuple (indexes used, plan).
+
+        On small tables PostgreSQL rightly prefers sequential scans. Set
+        disable_seqscan to check whether the indexes can be used at all.
+    """
+
+    with db_engine.connect() as conn:
+        row = conn.execute(
+            'SELECT canvas_id FROM curation_elements LIMIT 1'
+            ).fetchone()
+        can_db_id = row[0] if row else 0
+        trans = conn.begin()
+        if disable_seqscan:
+            conn.execute('SET LOCAL enable_seqscan = off')
+        q, params = backlinks_query(can_db_id, xywh)
+        q_explain = sqla_text('EXPLAIN (FORMAT JSON) {}'.format(q.text))
+        plan = conn.execute(q_explain, **params).fetchone()[0]
+        trans.rollback()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    plan = plan[0]['Plan']
+    used = _plan_index_names(plan) & set(TRACE_QUERY_INDEXES)
+    return used, plan
+
+
+if __name__ == '__main__':
+    db_engine = get_engine(get_cfg().db_uri)
+    migrate(db_engine)
+    if '--explain' in sys.argv[1:]:
+        for disable_seqscan in [False, True]:
+            used, plan = check_trace_query_plan(
+                db_engine,
+                disable_seqscan=disable_seqscan
+                )
+            print('{}: {}'.format(
+                'sequential scans disabled' if disable_seqscan else 'default',
+                ', '.join(sorted(used)) if used else 'NO INDEX USED'
+                ))
+        if not used:
+            sys.exit(1)
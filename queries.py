@@ -0,0 +1,378 @@
+""" SQL queries of the trace endpoint.
+"""
+
+import base64
+from sqlalchemy import text as sqla_text
+from config import get_cfg
+from db import get_engine
+
+
+# x, y, w and h of Curation elements as integers (elements are rectangles
+# indexed from integer coordinates, see crawler.insert_curation_elements)
+AREA_XYWH_COLUMNS = '''
+    CAST(ST_XMin(area) AS INTEGER) AS x,
+    CAST(ST_YMin(area) AS INTEGER) AS y,
+    CAST(ST_XMax(area) - ST_XMin(area) AS INTEGER) AS w,
+    CAST(ST_YMax(area) - ST_YMin(area) AS INTEGER) AS h'''
+
+
+def parse_xywh(xywh):
+    """ Parse a string 'x,y,w,h' into a tuple of four ints.
+    """
+
+    x, y, w, h = [int(elem) for elem in xywh.split(',')]
+    return x, y, w, h
+
+
+def encode_cursor(x, y, w, h):
+    """ Encode the last area of a page of trace results as an opaque cursor
+        pointing to the next page.
+    """
+
+    xywh = '{},{},{},{}'.format(x, y, w, h)
+    return base64.urlsafe_b64encode(xywh.encode('ascii')).decode(
+        'ascii'
+        ).rstrip('=')
+
+
+def decode_cursor(cursor):
+    """ Return the area (x, y, w, h) encoded in a cursor. Raises ValueError
+        for invalid cursors.
+    """
+
+    try:
+        xywh = base64.urlsafe_b64decode(
+            cursor + '=' * (-len(cursor) % 4)
+            ).decode('ascii')
+    except (TypeError, UnicodeDecodeError, base64.binascii.Error):
+        raise ValueError('invalid cursor')
+    return parse_xywh(xywh)
+
+
+def parse_page_args(args):
+    """ Return the pagination arguments of a trace query (limit, area after
+        which the page starts, max. backlinks per area) given its query
+        arguments (a mapping). Raises ValueError for invalid values.
+    """
+
+    cfg = get_cfg()
+    limit = int(args.get('limit', cfg.trace_page_size))
+    max_backlinks = int(args.get('max_backlinks', cfg.trace_max_backlinks))
+    after = None
+    if args.get('cursor'):
+        after = decode_cursor(args['cursor'])
+    if limit < 0 or max_backlinks < 0:
+        raise ValueError('negative limit')
+    if cfg.trace_max_page_size:
+        if limit == 0:
+            limit = cfg.trace_max_page_size
+        limit = min(limit, cfg.trace_max_page_size)
+    return limit or None, after, max_backlinks or None
+
+
+def group_backlinks(backlinks_flat):
+    """ Turn a list of (Curation URI, x, y, w, h) tuples into a dict mapping
+        areas ('x,y,w,h') to lists of Curation URIs.
+    """
+
+    backlinks_by_area = {}
+    for uri, x, y, w, h in backlinks_flat:
+        xywh = '{},{},{},{}'.format(x, y, w, h)
+        if xywh not in backlinks_by_area:
+            backlinks_by_area[xywh] = []
+        backlinks_by_area[xywh].append(uri)
+    return backlinks_by_area
+
+
+def first_page(backlinks_flat, limit=None, max_backlinks=None):
+    """ Turn a list of (Curation URI, x, y, w, h) tuples into the first page
+        of areas a trace query with the given limit and max. backlinks per
+        area would return, and a flag telling whether there are more (see
+        PostGISBackend.backlinks_page).
+    """
+
+    areas = {}
+    for uri, x, y, w, h in backlinks_flat:
+        entry = areas.setdefault((x, y, w, h), [[], 0])
+        if not max_backlinks or len(entry[0]) < max_backlinks:
+            entry[0].append(uri)
+        entry[1] += 1
+    page = sorted(areas.items())
+    has_more = limit is not None and len(page) > limit
+    return [area + (uris, n) for area, (uris, n) in page[:limit]], has_more
+
+
+def canvas_query(canvas_uri):
+    """ Query for the DB IDs and manifests of a canvas.
+    """
+
+    q = sqla_text('''
+        SELECT id, manifest_jsonld_id
+        FROM canvases
+        WHERE jsonld_id=:can_uri
+        ''')
+    return q, {'can_uri': canvas_uri}
+
+
+def backlinks_query(can_db_id, xywh=None):
+    """ Query for all Curation elements on a canvas (optionally only those
+        within the area xywh) and the URIs of the Curations they belong to.
+    """
+
+    params = {'can_id': can_db_id}
+    area_query_insert = ''
+    if xywh:
+        x, y, w, h = parse_xywh(xywh)
+        params.update({'x1': x, 'y1': y, 'x2': x+w, 'y2': y+h})
+        area_query_insert = \
+            'ST_Within(area, ST_MakeEnvelope(:x1, :y1, :x2, :y2)) and '
+    q = sqla_text('''SELECT curations.jsonld_id as uri, x, y, w, h,
+            cue.id as cue_id
+        FROM curations
+        JOIN
+            (SELECT id, curation_id, {}
+            FROM curation_elements
+            WHERE {} canvas_id = :can_id) as cue
+        ON curations.id = cue.curation_id;
+        '''.format(AREA_XYWH_COLUMNS, area_query_insert))
+    return q, params
+
+
+def backlinks_page_query(can_db_id, xywh=None, limit=None, after=None,
+                         max_backlinks=None):
+    """ Query for a page of the areas of Curation elements on a canvas
+        (optionally only those within the area xywh), ordered by area. Each
+        row contains an area, the number of Curation elements with that area
+        and the URIs of their Curations (at most max_backlinks). The page
+        contains (at most) limit areas following the area after.
+    """
+
+    q, params = backlinks_query(can_db_id, xywh)
+    inner = q.text.strip().rstrip(';')
+    after_query_insert = ''
+    if after is not None:
+        after_query_insert = 'WHERE (x, y, w, h) > (:ax, :ay, :aw, :ah)'
+        params.update(dict(zip(['ax', 'ay', 'aw', 'ah'], after)))
+    uris_column = 'array_agg(uri ORDER BY cue_id)'
+    if max_backlinks:
+        uris_column = '({})[1:{:d}]'.format(uris_column, max_backlinks)
+    limit_query_insert = ''
+    if limit is not None:
+        limit_query_insert = 'LIMIT {:d}'.format(limit)
+    q = sqla_text('''SELECT x, y, w, h, count(*) AS n, {} AS uris
+        FROM ({}) AS backlinks
+        {}
+        GROUP BY x, y, w, h
+        ORDER BY x, y, w, h
+        {};
+        '''.format(uris_column, inner, after_query_insert, limit_query_insert))
+    return q, params
+
+
+def areas_page(rows, limit):
+    """ Turn the result rows of a backlinks_page_query (made with a limit
+        of limit + 1) into a page of areas and a flag telling whether there
+        are more (see PostGISBackend.backlinks_page).
+    """
+
+    areas = [(row['x'], row['y'], row['w'], row['h'], row['uris'], row['n'])
+             for row in rows]
+    has_more = limit is not None and len(areas) > limit
+    return areas[:limit], has_more
+
+
+def batch_canvas_query(canvas_uris):
+    """ Query for the DB IDs and manifests of several canvases.
+    """
+
+    q = sqla_text('''
+        SELECT id, jsonld_id, manifest_jsonld_id
+        FROM canvases
+        WHERE jsonld_id = ANY(CAST(:can_uris AS TEXT[]))
+        ''')
+    return q, {'can_uris': list(canvas_uris)}
+
+
+def batch_backlinks_query(can_db_id_xywh_tups):
+    """ Query for the Curation elements of several (canvas DB ID, xywh)
+        pairs at once (xywh may be None). Every result row carries the
+        position n of the pair it belongs to. Rows are ordered by pair and
+        Curation element (like the URIs of backlinks_page_query).
+    """
+
+    params = {'can_ids': [], 'x1s': [], 'y1s': [], 'x2s': [], 'y2s': []}
+    for can_db_id, xywh in can_db_id_xywh_tups:
+        params['can_ids'].append(can_db_id)
+        if xywh:
+            x, y, w, h = parse_xywh(xywh)
+            area = [x, y, x+w, y+h]
+        else:
+            area = [None, None, None, None]
+        for key, val in zip(['x1s', 'y1s', 'x2s', 'y2s'], area):
+            params[key].append(val)
+    q = sqla_text('''SELECT q.n - 1 AS n, curations.jsonld_id as uri, {}
+        FROM unnest(CAST(:can_ids AS INTEGER[]), CAST(:x1s AS INTEGER[]),
+                    CAST(:y1s AS INTEGER[]), CAST(:x2s AS INTEGER[]),
+                    CAST(:y2s AS INTEGER[]))
+            WITH ORDINALITY AS q(can_id, x1, y1, x2, y2, n)
+        JOIN curation_elements
+        ON curation_elements.canvas_id = q.can_id
+            AND (q.x1 IS NULL OR
+                 ST_Within(area, ST_MakeEnvelope(q.x1, q.y1, q.x2, q.y2)))
+        JOIN curations
+        ON curations.id = curation_elements.curation_id
+        ORDER BY q.n, curation_elements.id;
+        '''.format(AREA_XYWH_COLUMNS))
+    return q, params
+
+
+def manifest_backlinks_query(manifest_uri):
+    """ Query for all canvases of a manifest and their Curation elements,
+        grouped by canvas and area and ordered by canvas. Canvases without
+        Curation elements are included with a NULL area.
+    """
+
+    q = sqla_text('''SELECT canvases.id, canvases.jsonld_id as canvas_uri,
+            x, y, w, h, array_agg(curations.jsonld_id) as uris
+        FROM canvases
+        LEFT JOIN
+            (SELECT canvas_id, curation_id, {}
+            FROM curation_elements) as cue
+        ON cue.canvas_id = canvases.id
+        LEFT JOIN curations
+        ON curations.id = cue.curation_id
+        WHERE canvases.manifest_jsonld_id = :man_uri
+        GROUP BY canvases.id, canvases.jsonld_id, x, y, w, h
+        ORDER BY canvases.id;
+        '''.format(AREA_XYWH_COLUMNS))
+    return q, {'man_uri': manifest_uri}
+
+
+def group_manifest_backlinks(rows):
+    """ Generate a (canvas URI, backlinks by area) tuple for every canvas
+        in the result rows of a manifest_backlinks_query (see
+        group_backlinks).
+    """
+
+    current_id = None
+    canvas_uri = None
+    backlinks_by_area = {}
+    for row in rows:
+        if row['id'] != current_id:
+            if current_id is not None:
+                yield canvas_uri, backlinks_by_area
+            current_id = row['id']
+            canvas_uri = row['canvas_uri']
+            backlinks_by_area = {}
+        if row['x'] is None:
+            continue
+        xywh = '{},{},{},{}'.format(row['x'], row['y'], row['w'], row['h'])
+        backlinks_by_area[xywh] = [uri for uri in row['uris']
+                                   if uri is not None]
+    if current_id is not None:
+        yield canvas_uri, backlinks_by_area
+
+
+class PostGISBackend():
+    """ Answers trace queries with the PostGIS DB. Unless an engine (or
+        connection) is given, that of the current process is used (see
+        db.get_engine), so that a backend created before worker processes
+        are forked doesn't share its connection pool with them.
+    """
+
+    def __init__(self, db_engine=None):
+        self._db_engine = db_engine
+
+    @property
+    def db_engine(self):
+        if self._db_engine is None:
+            return get_engine()
+        return self._db_engine
+
+    def canvases(self, canvas_uri):
+        """ Return a list of (canvas DB ID, manifest URI) tuples for a canvas
+            URI.
+        """
+
+        q, params = canvas_query(canvas_uri)
+        rows = self.db_engine.execute(q, **params).fetchall()
+        return [(int(row['id']), row['manifest_jsonld_id']) for row in rows]
+
+    def backlinks(self, can_db_id, xywh=None):
+        """ Return a list of (Curation URI, x, y, w, h) tuples for all
+            Curation elements on a canvas (optionally only those within the
+            area xywh).
+        """
+
+        q, params = backlinks_query(can_db_id, xywh)
+        backlinks = []
+        for row in self.db_engine.execute(q, **params).fetchall():
+            backlinks.append((row['uri'], row['x'], row['y'], row['w'],
+                              row['h']))
+        return backlinks
+
+    def backlinks_page(self, can_db_id, xywh=None, limit=None, after=None,
+                       max_backlinks=None):
+        """ Return a page of (at most limit) areas of Curation elements on a
+            canvas (optionally only those within the area xywh) following the
+            area after, as a list of (x, y, w, h, Curation URIs, number of
+            Curation elements) tuples, and a flag telling whether there are
+            more areas.
+
+            Curation URIs are limited to max_backlinks per area. Rows are
+            read from a server side cursor.
+        """
+
+        q, params = backlinks_page_query(
+            can_db_id,
+            xywh,
+            None if limit is None else limit + 1,
+            after,
+            max_backlinks
+            )
+        with self.db_engine.connect() as conn:
+            result = conn.execution_options(stream_results=True).execute(
+                q, **params
+                )
+            return areas_page(result, limit)
+
+    def manifest_backlinks(self, manifest_uri):
+        """ Generate a (canvas URI, backlinks by area) tuple for every canvas
+            of a manifest (see group_backlinks). The result rows are
+            streamed from the DB rather than loaded all at once.
+        """
+
+        q, params = manifest_backlinks_query(manifest_uri)
+        with self.db_engine.connect() as conn:
+            result = conn.execution_options(stream_results=True).execute(
+                q, **params
+                )
+            yield from group_manifest_backlinks(result)
+
+    def batch_canvases(self, canvas_uris):
+        """ Return a dict mapping each of the given canvas URIs that is known
+            to a list of (canvas DB ID, manifest URI) tuples.
+        """
+
+        q, params = batch_canvas_query(canvas_uris)
+        canvases = {}
+        for row in self.db_engine.execute(q, **params).fetchall():
+            canvases.setdefault(row['jsonld_id'], []).append(
+                (int(row['id']), row['manifest_jsonld_id'])
+                )
+        return canvases
+
+    def batch_backlinks(self, can_db_id_xywh_tups):
+        """ Return a list with the result of backlinks() for each of the
+            given (canvas DB ID, xywh) tuples.
+        """
+
+        results = [[] for _ in can_db_id_xywh_tups]
+        if not can_db_id_xywh_tups:
+            return results
+        q, params = batch_backlinks_query(can_db_id_xywh_tups)
+        for row in self.db_engine.execute(q, **params).fetchall():
+            results[row['n']].append(
+                (row['uri'], row['x'], row['y'], row['w'], row['h'])
+                )
+        return results
@@ -0,0 +1,254 @@
+""" Response cache for trace queries.
+
+    Cached responses are tagged with the crawl generation (see
+    crawler.bump_crawl_generation) they were built in. Whenever a crawl
+    changes data, the generation stored in the DB is incremented and all
+    responses of older generations are invalidated, consistently across all
+    worker processes.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from sqlalchemy import text as sqla_text
+
+
+def generation_query():
+    q = sqla_text('''
+        SELECT generation, changed_at
+        FROM crawl_generation
+        WHERE id=1''')
+    return q, {}
+
+
+class GenerationTracker():
+    """ Keeps track of the current crawl generation, reading it from the DB
+        at most once per check_interval seconds.
+    """
+
+    def __init__(self, check_interval):
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.checked = 0
+        self.generation = None
+        self.changed_at = None
+
+    def due(self):
+        """ Return whether the generation has to be read from the DB again.
+        """
+
+        return time.time() - self.checked >= self.check_interval
+
+    def update(self, row):
+        """ Set the generation from a result row of generation_query().
+        """
+
+        if row:
+            self.generation, self.changed_at = row[0], row[1]
+        self.checked = time.time()
+
+    def get(self, db_engine):
+        """ Return the tuple (generation, changed_at).
+        """
+
+        if not self.due():
+            return self.generation, self.changed_at
+        with self.lock:
+            if self.due():
+                q, params = generation_query()
+                self.update(db_engine.execute(q, **params).fetchone())
+        return self.generation, self.changed_at
+
+
+class MemoryBackend():
+    """ LRU cache within the process.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> (generation, created, value)
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key, generation, value):
+        with self.lock:
+            self.entries[key] = (generation, time.time(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def invalidate(self, generation):
+        """ Remove all entries not belonging to the given generation.
+        """
+
+        with self.lock:
+            self.entries = OrderedDict(
+                (key, entry) for key, entry in self.entries.items()
+                if entry[0] == generation
+                )
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class SQLiteBackend():
+    """ LRU cache in a local SQLite file that can be shared by all worker
+        processes on a machine.
+    """
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.local = threading.local()
+        self.evictions = 0
+        self._conn().execute('''
+            CREATE TABLE IF NOT EXISTS query_cache (
+              key TEXT PRIMARY KEY,
+              generation INTEGER,
+              created REAL,
+              accessed REAL,
+              value BLOB
+            )''')
+        self._conn().execute('''
+            CREATE INDEX IF NOT EXISTS query_cache_accessed
+            ON query_cache(accessed)''')
+
+    def _conn(self):
+        # connections can't be shared across threads or forked processes
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5,
+                                   isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def get(self, key):
+        conn = self._conn()
+        row = conn.execute('''
+            SELECT generation, created, value
+            FROM query_cache
+            WHERE key=?''', (key,)).fetchone()
+        if row is not None:
+            conn.execute('''
+                UPDATE query_cache
+                SET accessed=?
+                WHERE key=?''', (time.time(), key))
+            row = (row[0], row[1], bytes(row[2]))
+        return row
+
+    def set(self, key, generation, value):
+        conn = self._conn()
+        now = time.time()
+        conn.execute('''
+            INSERT OR REPLACE INTO query_cache
+            (key, generation, created, accessed, value)
+            VALUES (?, ?, ?, ?, ?)''', (key, generation, now, now, value))
+        cur = conn.execute('''
+            DELETE FROM query_cache
+            WHERE key IN (
+              SELECT key
+              FROM query_cache
+              ORDER BY accessed DESC
+              LIMIT -1 OFFSET ?)''', (self.size,))
+        self.evictions += cur.rowcount
+
+    def delete(self, key):
+        self._conn().execute('DELETE FROM query_cache WHERE key=?', (key,))
+
+    def invalidate(self, generation):
+        self._conn().execute('''
+            DELETE FROM query_cache
+            WHERE generation<>?''', (generation,))
+
+    def __len__(self):
+        return self._conn().execute(
+            'SELECT count(*) FROM query_cache'
+            ).fetchone()[0]
+
+
+class QueryCache():
+    """ Cache for serialized responses with a time to live and generation
+        based invalidation.
+    """
+
+    def __init__(self, backend, ttl):
+        self.backend = backend
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+
+    def _check_generation(self, generation):
+        if generation != self.generation:
+            self.backend.invalidate(generation)
+            self.generation = generation
+
+    def get(self, key, generation):
+        """ Return the cached value for key, or None if there is no valid
+            one for the given generation.
+        """
+
+        self._check_generation(generation)
+        entry = self.backend.get(key)
+        value = None
+        if entry is not None:
+            entry_generation, created, entry_value = entry
+            if entry_generation == generation and \
+                    time.time() - created < self.ttl:
+                value = entry_value
+            else:
+                self.backend.delete(key)
+        with self.lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key, generation, value):
+        self._check_generation(generation)
+        self.backend.set(key, generation, value)
+
+    def stats(self):
+        with self.lock:
+            hits, misses = self.hits, self.misses
+        total = hits + misses
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / total if total else 0.0,
+            'evictions': self.backend.evictions,
+            'entries': len(self.backend),
+            }
+
+
+def create_query_cache(cfg):
+    """ Create a QueryCache according to the config, or return None if
+        caching is disabled.
+    """
+
+    if cfg.query_cache_backend == 'memory':
+        backend = MemoryBackend(cfg.query_cache_size)
+    elif cfg.query_cache_backend == 'sqlite':
+        backend = SQLiteBackend(cfg.query_cache_path, cfg.query_cache_size)
+    else:
+        return None
+    return QueryCache(backend, cfg.query_cache_ttl)
@@ -0,0 +1,384 @@
+""" In-memory index of all Curation elements.
+
+    An alternative to PostGISBackend (see queries.py) for answering trace
+    queries without DB round trips. The whole index is loaded from the DB at
+    startup and reloaded when the crawl generation changes.
+
+    Usage:
+        python3 spatial_index.py [<n>]       compare the results of the
+                                             in-memory index with those of
+                                             PostGIS for n random canvases
+                                             (default: all)
+        python3 spatial_index.py --fixtures  compare them for fixed fixture
+                                             data (inserted in a transaction
+                                             that is rolled back)
+"""
+
+import random
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from config import get_cfg
+from db import get_engine
+from queries import AREA_XYWH_COLUMNS, PostGISBackend, group_backlinks
+from queries import parse_xywh
+
+
+class CanvasIndex():
+    """ Elements of a single canvas as parallel arrays, sorted by area (x
+        first) and then by DB ID, so that the Curations of an area are in
+        the order in which PostGISBackend aggregates them.
+
+        An element (x, y, w, h) is within an area (ax, ay, aw, ah) only if
+        ax <= x <= ax+aw, so candidates are found by bisecting the x
+        coordinates and then checked individually.
+    """
+
+    __slots__ = ('xs', 'ys', 'ws', 'hs', 'curs')
+
+    def __init__(self, elements):
+        """ elements: list of (x, y, w, h, element DB ID, Curation position)
+        """
+
+        elements.sort()
+        self.xs = array('q', (el[0] for el in elements))
+        self.ys = array('q', (el[1] for el in elements))
+        self.ws = array('q', (el[2] for el in elements))
+        self.hs = array('q', (el[3] for el in elements))
+        self.curs = array('l', (el[5] for el in elements))
+
+    def within(self, ax, ay, aw, ah):
+        """ Yield the positions of all elements within the given area.
+        """
+
+        xs, ys, ws, hs = self.xs, self.ys, self.ws, self.hs
+        ax2 = ax + aw
+        ay2 = ay + ah
+        for i in range(bisect_left(xs, ax), bisect_right(xs, ax2)):
+            y = ys[i]
+            if y >= ay and xs[i] + ws[i] <= ax2 and y + hs[i] <= ay2:
+                yield i
+
+
+class SpatialIndex():
+    """ All canvases, Curations and Curation elements of the DB.
+
+        URIs are interned: Curation URIs are stored once and referred to by
+        their position in curation_uris.
+    """
+
+    def __init__(self, generation):
+        self.generation = generation
+        self.canvas_ids = {}  # canvas URI -> [(canvas DB ID, manifest URI)]
+        # manifest URI -> [(canvas DB ID, canvas URI)]
+        self.manifest_canvases = {}
+        self.curation_uris = []
+        self.canvas_indexes = {}  # canvas DB ID -> CanvasIndex
+
+    @classmethod
+    def load(cls, db_engine, generation):
+        index = cls(generation)
+        with db_engine.connect() as conn:
+            conn = conn.execution_options(stream_results=True)
+            q_can = 'SELECT id, jsonld_id, manifest_jsonld_id FROM canvases'
+            for can_db_id, uri, manifest_uri in conn.execute(q_can):
+                index.canvas_ids.setdefault(uri, []).append(
+                    (can_db_id, manifest_uri)
+                    )
+                index.manifest_canvases.setdefault(manifest_uri, []).append(
+                    (can_db_id, uri)
+                    )
+            cur_pos = {}
+            q_cur = 'SELECT id, jsonld_id FROM curations'
+            for cur_db_id, uri in conn.execute(q_cur):
+                cur_pos[cur_db_id] = len(index.curation_uris)
+                index.curation_uris.append(uri)
+            q_cel = '''
+                SELECT id, canvas_id, curation_id, {}
+                FROM curation_elements
+                '''.format(AREA_XYWH_COLUMNS)
+            elements = {}
+            for cel_db_id, can_db_id, cur_db_id, x, y, w, h in conn.execute(
+                    q_cel):
+                if cur_db_id not in cur_pos:
+                    continue
+                elements.setdefault(can_db_id, []).append(
+                    (x, y, w, h, cel_db_id, cur_pos[cur_db_id])
+                    )
+        for can_db_id, can_elements in elements.items():
+            index.canvas_indexes[can_db_id] = CanvasIndex(can_elements)
+        for canvases in index.manifest_canvases.values():
+            canvases.sort()
+        return index
+
+    def canvases(self, canvas_uri):
+        return list(self.canvas_ids.get(canvas_uri, []))
+
+    def backlinks(self, can_db_id, xywh=None):
+        can_index = self.canvas_indexes.get(can_db_id)
+        if can_index is None:
+            return []
+        if xywh:
+            positions = can_index.within(*parse_xywh(xywh))
+        else:
+            positions = range(len(can_index.xs))
+        return [(self.curation_uris[can_index.curs[i]], can_index.xs[i],
+                 can_index.ys[i], can_index.ws[i], can_index.hs[i])
+                for i in positions]
+
+    def backlinks_page(self, can_db_id, xywh=None, limit=None, after=None,
+                       max_backlinks=None):
+        can_index = self.canvas_indexes.get(can_db_id)
+        if can_index is None:
+            return [], False
+        if xywh:
+            positions = can_index.within(*parse_xywh(xywh))
+        else:
+            positions = range(len(can_index.xs))
+        # elements are sorted by area, so equal areas are adjacent
+        areas = []  # [area, Curation URIs, number of elements]
+        has_more = False
+        for i in positions:
+            area = (can_index.xs[i], can_index.ys[i], can_index.ws[i],
+                    can_index.hs[i])
+            if after is not None and area <= tuple(after):
+                continue
+            if not areas or areas[-1][0] != area:
+                if limit is not None and len(areas) == limit:
+                    has_more = True
+                    break
+                areas.append([area, [], 0])
+            entry = areas[-1]
+            if not max_backlinks or len(entry[1]) < max_backlinks:
+                entry[1].append(self.curation_uris[can_index.curs[i]])
+            entry[2] += 1
+        return [area + (uris, n) for area, uris, n in areas], has_more
+
+    def manifest_backlinks(self, manifest_uri):
+        for can_db_id, canvas_uri in self.manifest_canvases.get(manifest_uri,
+                                                                []):
+            yield canvas_uri, group_backlinks(self.backlinks(can_db_id))
+
+    def batch_canvases(self, canvas_uris):
+        return {uri: self.canvases(uri) for uri in canvas_uris
+                if uri in self.canvas_ids}
+
+    def batch_backlinks(self, can_db_id_xywh_tups):
+        return [self.backlinks(can_db_id, xywh)
+                for can_db_id, xywh in can_db_id_xywh_tups]
+
+
+class MemoryBackend():
+    """ Answers trace queries with a SpatialIndex, which is replaced by a
+        newly loaded one whenever the crawl generation changes.
+    """
+
+    def __init__(self, generation_tracker, db_engine=None):
+        self._db_engine = db_engine
+        self.generation_tracker = generation_tracker
+        self.reload_lock = threading.Lock()
+        generation, _ = generation_tracker.get(self.db_engine)
+        self.index = SpatialIndex.load(self.db_engine, generation)
+
+    @property
+    def db_engine(self):
+        # (see PostGISBackend.db_engine)
+        if self._db_engine is None:
+            return get_engine()
+        return self._db_engine
+
+    def _current_index(self):
+        generation, _ = self.generation_tracker.get(self.db_engine)
+        index = self.index
+        if generation != index.generation and \
+                self.reload_lock.acquire(blocking=False):
+            # one thread reloads, all others keep using the old index
+            try:
+                if generation != self.index.generation:
+                    self.index = SpatialIndex.load(self.db_engine, generation)
+            finally:
+                self.reload_lock.release()
+            index = self.index
+        return index
+
+    def canvases(self, canvas_uri):
+        return self._current_index().canvases(canvas_uri)
+
+    def backlinks(self, can_db_id, xywh=None):
+        return self._current_index().backlinks(can_db_id, xywh)
+
+    def backlinks_page(self, can_db_id, xywh=None, limit=None, after=None,
+                       max_backlinks=None):
+        return self._current_index().backlinks_page(can_db_id, xywh, limit,
+                                                    after, max_backlinks)
+
+    def manifest_backlinks(self, manifest_uri):
+        return self._current_index().manifest_backlinks(manifest_uri)
+
+    def batch_canvases(self, canvas_uris):
+        return self._current_index().batch_canvases(canvas_uris)
+
+    def batch_backlinks(self, can_db_id_xywh_tups):
+        return self._current_index().batch_backlinks(can_db_id_xywh_tups)
+
+
+# Curations (URI, elements) inserted in this order by check_fixture_parity.
+# Elements are (canvas URI, manifest URI, x, y, w, h). Curation 2 gets an
+# element on an area of curation 1 only with its update, so that the order of
+# elements differs from that of Curations.
+FIXTURE_PREFIX = 'http://fixtures.invalid/'
+FIXTURE_CURATIONS = [
+    ('curation/2', [
+        ('canvas/1', 'manifest/1', 200, 0, 10, 10),
+        ]),
+    ('curation/1', [
+        ('canvas/1', 'manifest/1', 0, 0, 100, 100),
+        ('canvas/1', 'manifest/1', 0, 0, 100, 100),
+        ('canvas/1', 'manifest/1', 50, 50, 10, 10),
+        ('canvas/1', 'manifest/1', 0, 50, 10, 10),
+        ('canvas/2', 'manifest/1', 10, 20, 30, 40),
+        ]),
+    ('curation/2', [
+        ('canvas/1', 'manifest/1', 200, 0, 10, 10),
+        ('canvas/1', 'manifest/1', 0, 0, 100, 100),
+        ('canvas/1', 'manifest/1', 100, 100, 50, 50),
+        ('canvas/1', 'manifest/2', 0, 0, 100, 100),
+        ]),
+    ('curation/3', [
+        ('canvas/1', 'manifest/1', 0, 0, 100, 100),
+        ('canvas/1', 'manifest/1', 99, 0, 1, 1),
+        ('canvas/1', 'manifest/1', 0, 1, 100, 100),
+        ('canvas/2', 'manifest/1', 10, 20, 30, 40),
+        ('canvas/3', 'manifest/2', 0, 0, 5000, 5000),
+        ]),
+    ]
+# areas queried on every fixture canvas, including ones on element borders
+FIXTURE_AREAS = ['0,0,100,100', '0,0,99,100', '0,0,150,150', '50,50,10,10',
+                 '0,0,210,210', '1,0,300,300', '0,0,1,1', '-10,-10,20,20']
+
+
+def load_fixtures(db_conn):
+    """ Insert FIXTURE_CURATIONS (as the crawler would) and return the URIs
+        of their canvases.
+    """
+
+    from crawler import update_curation_elements
+
+    canvas_uris = set()
+    for n, (cur_path, elements) in enumerate(FIXTURE_CURATIONS):
+        elements = [(FIXTURE_PREFIX + can_path, FIXTURE_PREFIX + man_path,
+                     x, y, w, h)
+                    for can_path, man_path, x, y, w, h in elements]
+        update_curation_elements(FIXTURE_PREFIX + cur_path,
+                                 'fixture-{}'.format(n), elements, db_conn)
+        canvas_uris.update(el[0] for el in elements)
+    return sorted(canvas_uris)
+
+
+def check_parity(db_engine, n_canvases=None, regions_per_canvas=5,
+                 canvas_uris=None, areas=(), seed=None):
+    """ Compare the results of a freshly loaded SpatialIndex with those of
+        PostGISBackend for (up to n_canvases) canvases (or those given as
+        canvas_uris), each queried without an area, for the given areas and
+        for random areas (random numbers are generated from seed). Return a
+        list of mismatches as tuples (canvas URI, xywh, PostGIS result,
+        in-memory result).
+    """
+
+    rand = random.Random(seed)
+    index = SpatialIndex.load(db_engine, None)
+    postgis = PostGISBackend(db_engine)
+    if canvas_uris is None:
+        canvas_uris = sorted(index.canvas_ids.keys())
+    if n_canvases is not None:
+        canvas_uris = rand.sample(canvas_uris,
+                                  min(n_canvases, len(canvas_uris)))
+    mismatches = []
+    for canvas_uri in canvas_uris:
+        pg_canvases = sorted(postgis.canvases(canvas_uri))
+        mem_canvases = sorted(index.canvases(canvas_uri))
+        if pg_canvases != mem_canvases:
+            mismatches.append((canvas_uri, None, pg_canvases, mem_canvases))
+            continue
+        for can_db_id, _ in pg_canvases:
+            can_areas = [None] + list(areas)
+            all_elements = index.backlinks(can_db_id)
+            for _ in range(regions_per_canvas):
+                if all_elements:
+                    # areas around actual elements
+                    _, x, y, w, h = rand.choice(all_elements)
+                    dx, dy = rand.randint(0, 50), rand.randint(0, 50)
+                    can_areas.append('{},{},{},{}'.format(
+                        x - dx, y - dy,
+                        w + dx + rand.randint(-10, 50),
+                        h + dy + rand.randint(-10, 50)
+                        ))
+                else:
+                    can_areas.append('0,0,{},{}'.format(
+                        rand.randint(1, 5000),
+                        rand.randint(1, 5000)
+                        ))
+            for xywh in can_areas:
+                pg_result = sorted(postgis.backlinks(can_db_id, xywh))
+                mem_result = sorted(index.backlinks(can_db_id, xywh))
+                if pg_result != mem_result:
+                    mismatches.append((canvas_uri, xywh, pg_result,
+                                       mem_result))
+                # first two pages of two areas, with all and with only the
+                # first Curation of each area (the order of Curations
+                # matters, so they are compared as they are)
+                for max_backlinks in [None, 1]:
+                    after = None
+                    for _ in range(2):
+                        pg_page = postgis.backlinks_page(can_db_id, xywh, 2,
+                                                         after, max_backlinks)
+                        mem_page = index.backlinks_page(can_db_id, xywh, 2,
+                                                        after, max_backlinks)
+                        pg_result = [tuple(area[:4]) + (list(area[4]),
+                                                        area[5])
+                                     for area in pg_page[0]], pg_page[1]
+                        mem_result = [tuple(area[:4]) + (list(area[4]),
+                                                         area[5])
+                                      for area in mem_page[0]], mem_page[1]
+                        if pg_result != mem_result:
+                            mismatches.append((canvas_uri, xywh, pg_result,
+                                               mem_result))
+                        if not pg_page[1]:
+                            break
+                        after = pg_page[0][-1][:4]
+    return mismatches
+
+
+def check_fixture_parity(db_engine):
+    """ Compare the in-memory index with PostGIS for FIXTURE_CURATIONS (see
+        check_parity). The fixtures are inserted in a transaction that is
+        rolled back, so any DB with an up to date schema can be used.
+    """
+
+    with db_engine.connect() as conn:
+        trans = conn.begin()
+        try:
+            canvas_uris = load_fixtures(conn)
+            return check_parity(conn, canvas_uris=canvas_uris,
+                                areas=FIXTURE_AREAS, seed=0)
+        finally:
+            trans.rollback()
+
+
+if __name__ == '__main__':
+    db_engine = get_engine(get_cfg().db_uri)
+    start = time.time()
+    if '--fixtures' in sys.argv[1:]:
+        mismatches = check_fixture_parity(db_engine)
+    else:
+        n_canvases = int(sys.argv[1]) if len(sys.argv) > 1 else None
+        mismatches = check_parity(db_engine, n_canvases)
+    for canvas_uri, xywh, pg_result, mem_result in mismatches:
+        print('MISMATCH for {} (xywh={})\n  PostGIS: {}\n  in-memory: {}'.format(
+            canvas_uri, xywh, pg_result, mem_result
+            ))
+    print('{} mismatches ({:.1f}s)'.format(len(mismatches), time.time() - start))
+    if mismatches:
+        sys.exit(1)
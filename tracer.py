@@ -5,216 +5,166 @@
 """
 
 import atexit
-import copy
-import json
 import time
 import urllib.parse
-import uuid
-from config import Cfg
-from crawler import crawl
-from collections import OrderedDict
-from flask import Flask, request, abort, jsonify
-from sqlalchemy import text as sqla_text
-from sqlalchemy import create_engine
+from analytics import canvas_heatmap, top_canvases, top_manifests
+from builder import build_trace_page
+from builder import dumps, iter_manifest_curation_json, next_page_link
+from builder import trace_validators
+from config import get_cfg, install_sighup_handler
+from crawler import db_setup, schedule_crawls
+from flask import Flask, Response, request, abort
+from flask import stream_with_context
+from db import get_engine, pool_stats
+from metrics import process_metrics, register_collector
+from metrics import render as render_metrics
+from queries import PostGISBackend, first_page, parse_page_args
+from queries import parse_xywh
+from query_cache import GenerationTracker, create_query_cache
 from apscheduler.schedulers.background import BackgroundScheduler
+from werkzeug.http import is_resource_modified
 
-crawl()  # once at startup
-cfg = Cfg()
-scheduler = BackgroundScheduler()
-scheduler.add_job(
-    func=crawl,
-    trigger='interval',
-    hours=cfg.cfg['crawl_interval'])  # then at given interval
-scheduler.start()
+cfg = get_cfg()
+db_setup(cfg.db_uri)
+if cfg.crawl_embedded:
+    # crawls in the background, in at most one of all processes (see
+    # crawler.acquire_crawl_leadership)
+    scheduler = BackgroundScheduler()
+    schedule_crawls(scheduler)
+    scheduler.start()
 
-# Shut down the scheduler when exiting the app
-atexit.register(lambda: scheduler.shutdown())
+    # Shut down the scheduler when exiting the app
+    atexit.register(lambda: scheduler.shutdown())
 
 app = Flask(__name__)
+generation_tracker = GenerationTracker(cfg.query_cache_generation_check)
+query_cache = create_query_cache(cfg)
+if cfg.query_backend == 'memory':
+    from spatial_index import MemoryBackend
+    query_backend = MemoryBackend(generation_tracker)
+else:
+    query_backend = PostGISBackend()
+register_collector('db_pool', pool_stats)
+if query_cache is not None:
+    register_collector('query_cache', query_cache.stats)
 
 
-def query_hash(query_url):
-    """ Generate a compact identifier from a query URL. This idenifier is then
-        used for @ids of Ranges and Annotations.
-
-        IIIF URI pattern:
-            {scheme}://{host}/{prefix}/{identifier}/range/{name}
-            {scheme}://{host}/{prefix}/{identifier}/annotation/{name}
+def set_validators(resp, etag, last_modified):
+    """ Add the headers allowing clients and proxies to cache a trace
+        response and to revalidate it with a conditional request.
+    """
 
-        UUIDs are used for {name} and unique for every Range and Annotation.
-        (Not handled by this function.)
+    resp.set_etag(etag)
+    if last_modified:
+        resp.last_modified = last_modified
+    # may be stored, but has to be revalidated (see index)
+    resp.cache_control.no_cache = True
+    return resp
 
-        The return value of this function is used as {identifier} and
-        consistent across one query.
 
-        Example values:
-            query_hash('<tracer_instance>/?canvas=<...>&xywh=<...>')
-            '4adaf0dc94762893'
+def manifest_index(manifest_uri, etag, last_modified):
+    """ Respond with a curation containing all canvases of a manifest, each
+        annotated with curation backlinks. The response is streamed.
     """
 
-    return hex(abs(hash(query_url)))[2:]
+    canvas_backlinks = query_backend.manifest_backlinks(manifest_uri)
+    first = next(canvas_backlinks, None)
+    if first is None:
+        return abort(404)
+
+    def all_canvas_backlinks():
+        yield first
+        yield from canvas_backlinks
 
+    return set_validators(Response(
+        stream_with_context(iter_manifest_curation_json(
+            manifest_uri,
+            all_canvas_backlinks(),
+            request.url,
+            request.base_url)),
+        mimetype='application/json'), etag, last_modified)
 
-def build_annotation_container_curation(
-    canvas_uri, containing_manifest_uri, backlinks, query_url, base_url
-    ):
-    """ Build a curation containing a single canvas that is annotated with
-        curation backlinks.
+
+def page_args():
+    """ Return the pagination arguments of a trace query (limit, area after
+        which the page starts, max. backlinks per area) or abort if they are
+        invalid.
     """
 
-    q_hash = query_hash(query_url)
-    cfg = Cfg()
-    curation_link_prefix = cfg.cfg['curation_link_prefix']
-    if len(curation_link_prefix) > 0:
-        use_prefix = True
-    else:
-        use_prefix = False
-    marker_settings = cfg.cfg['marker_settings']
-
-    if base_url[-1] == '/':
-        base_url = base_url[:-1]
-
-    cur = OrderedDict()
-    cur['@context'] = ['http://iiif.io/api/presentation/2/context.json',
-                       ('http://codh.rois.ac.jp/iiif/curation/1/context.js'
-                        'on')]
-    cur['@type'] = 'cr:Curation'
-    cur['@id'] = query_url
-    cur['viewingHint'] = 'annotation'
-    cur['label'] = 'Tracing Curations for {}'.format(canvas_uri)
-    cur['selections'] = []
-    sel = OrderedDict()
-    sel['@id'] = '{}/trace/{}/range/{}'.format(base_url, q_hash, uuid.uuid1())
-    sel['@type'] = 'sc:Range'
-    sel['label'] = 'Temporary range for displaying a canvas'
-    sel['members'] = []
-    mem = OrderedDict()
-    mem['@id'] = canvas_uri
-    mem['@type'] = 'sc:Canvas'
-    mem['label'] = 'Temporary canvas for displaying annotations'
-    mem['metadata'] = []
-    for xywh, uris in backlinks.items():
-        # For every area
-        mtd = OrderedDict()
-        mtd['label'] = 'Annotation'
-        mtd['value'] = []
-        # Create a single annotation
-        ann = OrderedDict()
-        ann['@id'] = '{}/trace/{}/annotation/{}'.format(
-            base_url, q_hash, uuid.uuid1()
+    try:
+        return parse_page_args(request.args)
+    except ValueError:
+        return abort(400)
+
+
+def trace_response(body, next_cursor, etag, last_modified):
+    resp = Response(body, mimetype='application/json')
+    if next_cursor:
+        resp.headers['Link'] = next_page_link(
+            request.base_url,
+            request.args.to_dict(flat=False),
+            next_cursor
             )
-        ann['@type'] = 'oa:Annotation'
-        ann['motivation'] = 'sc:painting'
-        ann['on'] = '{}#xywh={}'.format(canvas_uri, xywh)
-        ann['resource'] = OrderedDict()
-        ann['resource']['@type'] = 'cnt:ContentAsText'
-        ann['resource']['format'] = 'text/html'
-        # With a list of all backlinks to curations
-        backlink_list_chars = ''
-        for i, uri in enumerate(uris):
-            if i > 0:
-                backlink_list_chars += ',<br>'
-            backlink_uri = uri
-            if use_prefix:
-                backlink_uri = '{}{}'.format(
-                    curation_link_prefix,
-                    uri
-                    )
-            backlink_list_chars += '<a href="{}">Curation {}</a>'.format(
-                backlink_uri, i+1
-                )
-        ann['resource']['chars'] = backlink_list_chars
-        ann['resource']['marker'] = OrderedDict()
-        for key, val in marker_settings.items():
-            ann['resource']['marker'][key] = val
-        mtd['value'].append(copy.deepcopy(ann))
-        mem['metadata'].append(copy.deepcopy(mtd))
-    sel['members'].append(copy.deepcopy(mem))
-    sel['within'] = OrderedDict()
-    sel['within']['@id'] = containing_manifest_uri
-    sel['within']['@type'] = 'sc:Manifest'
-    sel['within']['label'] = 'Temporary manifest for displaying a canvas'
-    cur['selections'].append(copy.deepcopy(sel))
-    return cur
+    return set_validators(resp, etag, last_modified)
 
 
 @app.route('/', methods=['GET'])
 def index():
     canvas_uri_raw = request.args.get('canvas')
     area_xywh = request.args.get('xywh')
-    if not canvas_uri_raw:
+    manifest_uri_raw = request.args.get('manifest')
+    if not canvas_uri_raw and not manifest_uri_raw:
         return abort(400)
+
+    db_engine = get_engine()
+    # responses only change when a crawl changes data, so conditional
+    # requests are answered from the cached crawl generation (without
+    # accessing the DB, unless the generation is due to be checked)
+    generation, changed_at = generation_tracker.get(db_engine)
+    etag, last_modified = trace_validators(request.url, generation,
+                                           changed_at)
+    if not is_resource_modified(request.environ, etag,
+                                last_modified=last_modified):
+        return set_validators(Response(status=304), etag, last_modified)
+
+    if not canvas_uri_raw:
+        return manifest_index(urllib.parse.unquote(manifest_uri_raw), etag,
+                              last_modified)
     canvas_uri = urllib.parse.unquote(canvas_uri_raw)
+    limit, after, max_backlinks = page_args()
 
-    cfg = Cfg()
-    db_engine = create_engine(cfg.cfg['db_uri'])
-
-    q_can = sqla_text('''
-        SELECT id, manifest_jsonld_id
-        FROM canvases
-        WHERE jsonld_id=:can_uri
-        ''')
-    can_db_tpls = db_engine.execute(
-        q_can,
-        can_uri=canvas_uri
-        ).fetchall()
+    if query_cache is not None:
+        cache_key = '\n'.join([canvas_uri, area_xywh or '', request.url])
+        cached = query_cache.get(cache_key, generation)
+        if cached is not None and b'\n' in cached:
+            # cursor of the next page (if any) in the first line
+            next_cursor, body = cached.split(b'\n', 1)
+            return trace_response(body, next_cursor.decode('ascii'), etag,
+                                  last_modified)
+
+    start = time.perf_counter()
+    can_db_tpls = query_backend.canvases(canvas_uri)
     if not can_db_tpls:
         return abort(404)  # FIXME not there, respond accordingly
     else:
         if len(can_db_tpls) == 1:
-            can_db_id = int(can_db_tpls[0]['id'])
-            can_db_man_jsonld_id = can_db_tpls[0]['manifest_jsonld_id']
+            can_db_id, can_db_man_jsonld_id = can_db_tpls[0]
         else:
             print('multiple canvases w/ same ID (!!!)')  # FIXME problem
 
-    area_query_insert = ''
-    if area_xywh:
-        x, y, w, h = [int(elem) for elem in area_xywh.split(',')]
-        poly = ('ST_GeomFromText('
-            '\'POLYGON(({} {}, {} {}, {} {}, {} {}, {} {}))\')').format(
-            x, y,
-            x+w, y,
-            x+w, y+h,
-            x, y+h,
-            x, y
-            )
-        area_query_insert = 'ST_Within(area, {}) and '.format(poly)
-    q_area = '''SELECT curations.jsonld_id as uri, areajson
-        FROM curations
-        JOIN
-            (SELECT curation_id, ST_AsGeoJSON(area) as areajson
-            FROM curation_elements
-            WHERE {} canvas_id = {}) as cue
-        ON curations.id = cue.curation_id;
-        '''.format(area_query_insert, can_db_id)
-    cur_uris = db_engine.execute(q_area).fetchall()
-
-    backlinks_flat = []
-    for row in cur_uris:
-        uri = row['uri']
-        area = json.loads(row['areajson'])
-        backlinks_flat.append([uri, area])
-    # backlinks_by_uri = {}
-    # for bl in backlinks_flat:
-    #     uri, area = bl
-    #     if uri not in backlinks_by_uri:
-    #         backlinks_by_uri[uri] = {'areas':[]}
-    #     backlinks_by_uri[uri]['areas'].append(area)
-    backlinks_by_area = {}
-    for bl in backlinks_flat:
-        uri, area = bl
-        coords = area['coordinates'][0]
-        if not len(coords) == 5:
-            print('unexpected polygon shape (!!!)')  # FIXME problem
-        p1, p2, p3, p4, p5 = coords
-        xywh = '{},{},{},{}'.format(p1[0], p1[1], p2[0]-p1[0], p3[1]-p1[1])
-        if xywh not in backlinks_by_area:
-            backlinks_by_area[xywh] = []
-        backlinks_by_area[xywh].append(uri)
-    display_curation = build_annotation_container_curation(
+    areas, has_more = query_backend.backlinks_page(
+        can_db_id,
+        area_xywh,
+        limit,
+        after,
+        max_backlinks
+        )
+    db_done = time.perf_counter()
+    display_curation, next_cursor = build_trace_page(
         canvas_uri,
         can_db_man_jsonld_id,
-        backlinks_by_area,
+        areas,
+        has_more,
         request.url,
         request.base_url)
 
@@ -223,7 +173,145 @@ def index():
     #     'curations_backlinks': backlinks_by_area
     #     }
 
-    return jsonify(display_curation)
+    build_done = time.perf_counter()
+    body = dumps(display_curation)
+    process_metrics().observe_query(db_done - start, build_done - db_done,
+                                    time.perf_counter() - build_done)
+    if query_cache is not None:
+        query_cache.set(cache_key, generation,
+                        next_cursor.encode('ascii') + b'\n' + body)
+    return trace_response(body, next_cursor, etag, last_modified)
+
+
+@app.route('/batch', methods=['POST'])
+def batch():
+    """ Answer several trace queries at once. Expects a JSON list of objects
+        with a canvas URI (key "canvas") and an optional area (key "xywh").
+        Responds with a JSON list containing, for each query, the same
+        Curation a GET request for it would return (the first page, with
+        the configured page size and max. backlinks per area), or null if the
+        canvas is not known.
+    """
+
+    queries = request.get_json(silent=True)
+    if not isinstance(queries, list) or \
+            len(queries) > cfg.batch_max_queries:
+        return abort(400)
+    canvas_xywh_tups = []
+    for query in queries:
+        if not isinstance(query, dict) or \
+                not isinstance(query.get('canvas'), str):
+            return abort(400)
+        area_xywh = query.get('xywh') or None
+        if area_xywh is not None:
+            try:
+                parse_xywh(area_xywh)
+            except (AttributeError, ValueError):
+                return abort(400)
+        canvas_xywh_tups.append((query['canvas'], area_xywh))
+
+    start = time.perf_counter()
+    canvases = query_backend.batch_canvases(
+        set(canvas_uri for canvas_uri, _ in canvas_xywh_tups)
+        )
+    # (query position, canvas DB ID, manifest URI) of known canvases
+    found = []
+    for i, (canvas_uri, area_xywh) in enumerate(canvas_xywh_tups):
+        can_db_tpls = canvases.get(canvas_uri)
+        if can_db_tpls:
+            if len(can_db_tpls) > 1:
+                print('multiple canvases w/ same ID (!!!)')  # FIXME problem
+            can_db_id, can_db_man_jsonld_id = can_db_tpls[0]
+            found.append((i, can_db_id, can_db_man_jsonld_id))
+    backlinks_flat_lists = query_backend.batch_backlinks(
+        [(can_db_id, canvas_xywh_tups[i][1]) for i, can_db_id, _ in found]
+        )
+
+    db_done = time.perf_counter()
+    limit, _, max_backlinks = parse_page_args({})
+    results = [None] * len(canvas_xywh_tups)
+    for (i, _, can_db_man_jsonld_id), backlinks_flat in zip(
+            found, backlinks_flat_lists):
+        canvas_uri, area_xywh = canvas_xywh_tups[i]
+        query_args = [('canvas', canvas_uri)]
+        if area_xywh:
+            query_args.append(('xywh', area_xywh))
+        query_url = '{}?{}'.format(
+            request.url_root,
+            urllib.parse.urlencode(query_args)
+            )
+        areas, has_more = first_page(backlinks_flat, limit, max_backlinks)
+        results[i], _ = build_trace_page(
+            canvas_uri,
+            can_db_man_jsonld_id,
+            areas,
+            has_more,
+            query_url,
+            request.url_root)
+    build_done = time.perf_counter()
+    body = dumps(results)
+    process_metrics().observe_query(db_done - start, build_done - db_done,
+                                    time.perf_counter() - build_done)
+    return Response(body, mimetype='application/json')
+
+
+def stats_limit():
+    """ Return the number of entries requested from a stats endpoint or
+        abort if it is invalid.
+    """
+
+    try:
+        limit = int(request.args.get('limit', cfg.stats_default_limit))
+    except ValueError:
+        return abort(400)
+    if limit < 1:
+        return abort(400)
+    return min(limit, cfg.stats_max_limit)
+
+
+@app.route('/stats/canvases', methods=['GET'])
+def stats_canvases():
+    """ The most curated canvases (optionally only those of a manifest).
+    """
+
+    manifest_uri = request.args.get('manifest')
+    return Response(dumps(top_canvases(get_engine(), stats_limit(),
+                                       manifest_uri)),
+                    mimetype='application/json')
+
+
+@app.route('/stats/manifests', methods=['GET'])
+def stats_manifests():
+    """ The most curated manifests.
+    """
+
+    return Response(dumps(top_manifests(get_engine(), stats_limit())),
+                    mimetype='application/json')
+
+
+@app.route('/stats/heatmap', methods=['GET'])
+def stats_heatmap():
+    """ How often the regions of a canvas are cut out.
+    """
+
+    canvas_uri = request.args.get('canvas')
+    if not canvas_uri:
+        return abort(400)
+    heatmap = canvas_heatmap(get_engine(), canvas_uri)
+    if heatmap is None:
+        return abort(404)
+    return Response(dumps(heatmap), mimetype='application/json')
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """ Metrics of crawls and queries in the Prometheus text format.
+    """
+
+    return Response(render_metrics(get_engine()),
+                    content_type='text/plain; version=0.0.4; charset=utf-8')
+
 
 if __name__ == '__main__':
-    app.run(port=cfg.cfg['port'])
+    install_sighup_handler()
+    app.run(port=cfg.port)
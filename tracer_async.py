@@ -0,0 +1,332 @@
+""" Curation Tracer, ASGI variant of the trace endpoint.
+
+    Answers trace queries (/?canvas=... and /?manifest=...) with the same
+    responses as tracer.py, but uses the async PostgreSQL driver asyncpg, so
+    that a single process can serve many concurrent queries while they wait
+    for the DB. SQL queries and responses are built by the same code as in
+    tracer.py (see queries.py and builder.py).
+
+    Crawling, DB migrations and the other endpoints are left to tracer.py
+    (or crawler.py), and the query cache isn't used.
+
+    Usage:
+        uvicorn tracer_async:app --port <port>
+"""
+
+import asyncio
+import re
+import time
+import urllib.parse
+import asyncpg
+from werkzeug.exceptions import default_exceptions
+from werkzeug.http import http_date, is_resource_modified, quote_etag
+from werkzeug.urls import url_decode
+from werkzeug.wsgi import get_current_url
+from builder import ManifestCurationJSON, build_trace_page, dumps
+from builder import next_page_link, trace_validators
+from config import get_cfg
+from metrics import process_metrics
+from queries import areas_page, backlinks_page_query, canvas_query
+from queries import group_manifest_backlinks, manifest_backlinks_query
+from queries import parse_page_args, parse_xywh
+from query_cache import GenerationTracker, generation_query
+
+# named parameters (:name) of SQLAlchemy text queries, but not casts (::)
+PARAM_PATTERN = re.compile(r'(?<![:\w]):(\w+)')
+# rows of a manifest query fetched from its cursor at a time
+MANIFEST_FETCH_SIZE = 1000
+
+_pool = None
+_pool_lock = None
+generation_tracker = GenerationTracker(get_cfg().query_cache_generation_check)
+
+
+def positional_query(q, params):
+    """ Convert a SQLAlchemy text query with named parameters (as built in
+        queries.py) and its parameters into SQL with the numbered parameters
+        asyncpg expects ($1, $2, ...) and a list of arguments.
+    """
+
+    names = []
+
+    def number(match):
+        name = match.group(1)
+        if name not in names:
+            names.append(name)
+        return '${}'.format(names.index(name) + 1)
+
+    sql = PARAM_PATTERN.sub(number, q.text)
+    return sql, [params[name] for name in names]
+
+
+def asyncpg_dsn(db_uri):
+    """ Turn an SQLAlchemy DB URI (which may name a driver, e.g.
+        postgresql+psycopg2://...) into a DSN for asyncpg.
+    """
+
+    scheme, rest = db_uri.split('://', 1)
+    return '{}://{}'.format(scheme.split('+')[0], rest)
+
+
+async def get_pool():
+    """ Return this process' asyncpg connection pool.
+    """
+
+    global _pool, _pool_lock
+
+    if _pool is None:
+        # created here rather than at import, so that it belongs to the
+        # running event loop
+        if _pool_lock is None:
+            _pool_lock = asyncio.Lock()
+        async with _pool_lock:
+            if _pool is None:
+                cfg = get_cfg()
+                _pool = await asyncpg.create_pool(
+                    asyncpg_dsn(cfg.db_uri),
+                    min_size=1,
+                    max_size=cfg.async_db_pool_size)
+    return _pool
+
+
+async def fetch(conn, q, params):
+    sql, args = positional_query(q, params)
+    return await conn.fetch(sql, *args)
+
+
+async def crawl_generation(pool):
+    """ Return the tuple (generation, changed_at), reading it from the DB
+        only if it is due to be checked again.
+    """
+
+    if generation_tracker.due():
+        async with pool.acquire() as conn:
+            rows = await fetch(conn, *generation_query())
+        generation_tracker.update(rows[0] if rows else None)
+    return generation_tracker.generation, generation_tracker.changed_at
+
+
+def validator_headers(etag, last_modified):
+    """ The caching headers tracer.set_validators adds.
+    """
+
+    headers = [('ETag', quote_etag(etag))]
+    if last_modified:
+        headers.append(('Last-Modified', http_date(last_modified)))
+    headers.append(('Cache-Control', 'no-cache'))
+    return headers
+
+
+def wsgi_environ(scope):
+    """ The parts of a WSGI environ werkzeug needs to reconstruct the URL of
+        a request, so that URLs in responses are exactly those of tracer.py.
+    """
+
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        }
+    for key, val in scope['headers']:
+        name = key.decode('latin-1').upper().replace('-', '_')
+        environ['HTTP_{}'.format(name)] = val.decode('latin-1')
+    return environ
+
+
+async def start_response(send, status, headers):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(key.encode('latin-1'), val.encode('latin-1'))
+                    for key, val in headers],
+        })
+
+
+async def send_chunk(send, chunk):
+    await send({'type': 'http.response.body', 'body': chunk,
+                'more_body': True})
+
+
+async def end_response(send):
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+async def send_response(send, status, headers, chunks, head_only=False):
+    """ Send a response with a body given as an iterable of bytes.
+    """
+
+    await start_response(send, status, headers)
+    if not head_only:
+        for chunk in chunks:
+            await send_chunk(send, chunk)
+    await end_response(send)
+
+
+async def send_error(send, status, environ, head_only=False):
+    # same error pages as flask.abort
+    if status == 405:
+        error = default_exceptions[status](valid_methods=['GET', 'HEAD'])
+    else:
+        error = default_exceptions[status]()
+    await send_response(
+        send,
+        status,
+        error.get_headers(environ),
+        [error.get_body(environ).encode('utf-8')],
+        head_only)
+
+
+async def manifest_index(send, manifest_uri, environ, head_only,
+                         validators):
+    """ Respond with a curation containing all canvases of a manifest, each
+        annotated with curation backlinks. The rows are fetched from a cursor
+        MANIFEST_FETCH_SIZE at a time and the response is sent while they
+        are, so large manifests are not held in memory.
+    """
+
+    pool = await get_pool()
+    sql, args = positional_query(*manifest_backlinks_query(manifest_uri))
+    # (cursors only exist within transactions)
+    async with pool.acquire() as conn, conn.transaction():
+        cursor = await conn.cursor(sql, *args)
+        rows = await cursor.fetch(MANIFEST_FETCH_SIZE)
+        if not rows:
+            return await send_error(send, 404, environ, head_only)
+        await start_response(
+            send,
+            200,
+            [('Content-Type', 'application/json')] + validators)
+        if head_only:
+            return await end_response(send)
+        curation_json = ManifestCurationJSON(
+            manifest_uri,
+            get_current_url(environ),
+            get_current_url(environ, strip_querystring=True))
+        await send_chunk(send, curation_json.head())
+        while rows:
+            more = await cursor.fetch(MANIFEST_FETCH_SIZE)
+            # rows are ordered by canvas, but the rows of the last canvas
+            # may continue in the next batch
+            complete = len(rows)
+            if more:
+                while complete > 0 and rows[complete - 1]['id'] == \
+                        more[0]['id']:
+                    complete -= 1
+            for canvas_uri, backlinks in group_manifest_backlinks(
+                    rows[:complete]):
+                await send_chunk(send, curation_json.member(canvas_uri,
+                                                            backlinks))
+            rows = rows[complete:] + more
+        await send_chunk(send, curation_json.tail())
+    await end_response(send)
+
+
+async def index(send, environ, head_only):
+    args = url_decode(environ['QUERY_STRING'].encode('latin-1'))
+    canvas_uri_raw = args.get('canvas')
+    area_xywh = args.get('xywh')
+    manifest_uri_raw = args.get('manifest')
+    if not canvas_uri_raw and not manifest_uri_raw:
+        return await send_error(send, 400, environ, head_only)
+
+    pool = await get_pool()
+    # (see tracer.index)
+    generation, changed_at = await crawl_generation(pool)
+    etag, last_modified = trace_validators(get_current_url(environ),
+                                           generation, changed_at)
+    validators = validator_headers(etag, last_modified)
+    if not is_resource_modified(environ, etag, last_modified=last_modified):
+        return await send_response(send, 304, validators, [], head_only)
+
+    if not canvas_uri_raw:
+        return await manifest_index(send,
+                                    urllib.parse.unquote(manifest_uri_raw),
+                                    environ, head_only, validators)
+    canvas_uri = urllib.parse.unquote(canvas_uri_raw)
+    try:
+        limit, after, max_backlinks = parse_page_args(args)
+        if area_xywh:
+            parse_xywh(area_xywh)
+    except ValueError:
+        return await send_error(send, 400, environ, head_only)
+
+    start = time.perf_counter()
+    async with pool.acquire() as conn:
+        q, params = canvas_query(canvas_uri)
+        can_rows = await fetch(conn, q, params)
+        if not can_rows:
+            return await send_error(send, 404, environ, head_only)
+        if len(can_rows) > 1:
+            print('multiple canvases w/ same ID (!!!)')  # FIXME problem
+        can_db_id = int(can_rows[0]['id'])
+        can_db_man_jsonld_id = can_rows[0]['manifest_jsonld_id']
+        q, params = backlinks_page_query(
+            can_db_id,
+            area_xywh,
+            None if limit is None else limit + 1,
+            after,
+            max_backlinks
+            )
+        areas, has_more = areas_page(await fetch(conn, q, params), limit)
+    db_done = time.perf_counter()
+    base_url = get_current_url(environ, strip_querystring=True)
+    display_curation, next_cursor = build_trace_page(
+        canvas_uri,
+        can_db_man_jsonld_id,
+        areas,
+        has_more,
+        get_current_url(environ),
+        base_url)
+    build_done = time.perf_counter()
+    body = dumps(display_curation)
+    process_metrics().observe_query(db_done - start, build_done - db_done,
+                                    time.perf_counter() - build_done)
+    headers = [('Content-Type', 'application/json'),
+               ('Content-Length', str(len(body)))]
+    if next_cursor:
+        headers.append(('Link', next_page_link(
+            base_url,
+            args.to_dict(flat=False),
+            next_cursor
+            )))
+    await send_response(send, 200, headers + validators, [body], head_only)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            try:
+                await get_pool()
+            except Exception as e:
+                await send({'type': 'lifespan.startup.failed',
+                            'message': str(e)})
+                return
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if _pool is not None:
+                await _pool.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    """ The ASGI application.
+    """
+
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+    environ = wsgi_environ(scope)
+    head_only = scope['method'] == 'HEAD'
+    if scope['path'] != '/':
+        return await send_error(send, 404, environ, head_only)
+    if scope['method'] not in ['GET', 'HEAD']:
+        return await send_error(send, 405, environ, head_only)
+    await index(send, environ, head_only)